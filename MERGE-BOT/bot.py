@@ -4,7 +4,6 @@ load_dotenv(
     "config.env",
     override=True,
 )
-import asyncio
 import os
 import shutil
 import time
@@ -13,12 +12,6 @@ import psutil
 import pyromod
 from PIL import Image
 from pyrogram import Client, filters,enums
-from pyrogram.errors import (
-    FloodWait,
-    InputUserDeactivated,
-    PeerIdInvalid,
-    UserIsBlocked,
-)
 from pyrogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
@@ -44,6 +37,13 @@ from __init__ import (
 )
 from config import Config
 from helpers import database
+from helpers.broadcast import Broadcast
+from helpers.file_type_detection import MediaTypeDetector
+from helpers.queue_markup import forgetQueueMarkup, queueMarkup, queuedFileMeta, rememberQueuedFile
+from helpers.queue_store import queueStore
+from helpers.rclone_config import TUNING_FLAGS, rcloneRegistry
+from helpers.thumbnail import userThumbnail
+from helpers.user_session import LOGCHANNEL, userBot, userSession
 from helpers.utils import UserSettings, get_readable_file_size, get_readable_time
 
 botStartTime = time.time()
@@ -60,6 +60,7 @@ class MergeBot(Client):
         return LOGGER.info("Bot Started!")
 
     def stop(self):
+        UserSettings.flush()
         super().stop()
         return LOGGER.info("Bot Stopped")
 
@@ -87,7 +88,7 @@ async def sendLogFile(c: Client, m: Message):
 
 @mergeApp.on_message(filters.command(["login"]) & filters.private)
 async def loginHandler(c: Client, m: Message):
-    user = UserSettings(m.from_user.id, m.from_user.first_name)
+    user = await UserSettings.load(m.from_user.id, m.from_user.first_name)
     if user.banned:
         await m.reply_text(text=f"**Banned User Detected!**\n  🛡️ Unfortunately you can't use me\n\nContact: 🈲 @{Config.OWNER_USERNAME}", quote=True)
         return
@@ -112,6 +113,7 @@ async def loginHandler(c: Client, m: Message):
                 quote=True,
             )
     user.set()
+    UserSettings.invalidate(user.user_id)
     del user
     return
 
@@ -151,47 +153,31 @@ async def stats_handler(c: Client, m: Message):
 )
 async def broadcast_handler(c: Client, m: Message):
     msg = m.reply_to_message
-    userList = await database.broadcast()
-    len = userList.collection.count_documents({})
-    status = await m.reply_text(text=BROADCAST_MSG.format(str(len), "0"), quote=True)
-    success = 0
-    for i in range(len):
-        try:
-            uid = userList[i]["_id"]
-            if uid != int(Config.OWNER):
-                await msg.copy(chat_id=uid)
-            success = i + 1
-            await status.edit_text(text=BROADCAST_MSG.format(len, success))
-            LOGGER.info(f"Message sent to {userList[i]['name']} ")
-        except FloodWait as e:
-            await asyncio.sleep(e.x)
-            await msg.copy(chat_id=userList[i]["_id"])
-            LOGGER.info(f"Message sent to {userList[i]['name']} ")
-        except InputUserDeactivated:
-            await database.deleteUser(userList[i]["_id"])
-            LOGGER.info(f"{userList[i]['_id']} - {userList[i]['name']} : deactivated\n")
-        except UserIsBlocked:
-            await database.deleteUser(userList[i]["_id"])
-            LOGGER.info(
-                f"{userList[i]['_id']} - {userList[i]['name']} : blocked the bot\n"
-            )
-        except PeerIdInvalid:
-            await database.deleteUser(userList[i]["_id"])
-            LOGGER.info(
-                f"{userList[i]['_id']} - {userList[i]['name']} : user id invalid\n"
-            )
-        except Exception as err:
-            LOGGER.warning(f"{err}\n")
-        await asyncio.sleep(3)
-    await status.edit_text(
-        text=BROADCAST_MSG.format(len, success)
-        + f"**Failed: {str(len-success)}**\n\n__🤓 Broadcast completed sucessfully__",
+    checkpoint = await database.getBroadcastCheckpoint()
+    if checkpoint is not None and (
+        msg is None
+        or (checkpoint["chat_id"], checkpoint["message_id"]) == (msg.chat.id, msg.id)
+    ):
+        # resume the interrupted broadcast of the same message
+        msg = await c.get_messages(checkpoint["chat_id"], checkpoint["message_id"])
+        userList = await database.getBroadcastUsers(after=checkpoint["watermark"])
+    elif msg is None:
+        await m.reply_text("Reply /broadcast to the message you want to send", quote=True)
+        return
+    else:
+        checkpoint = None
+        userList = await database.getBroadcastUsers()
+    total = checkpoint["total"] if checkpoint else len(userList)
+    status = await m.reply_text(
+        text=BROADCAST_MSG.format(str(total), str(checkpoint["success"] if checkpoint else 0)),
+        quote=True,
     )
+    await Broadcast(msg, status, userList, checkpoint).run()
 
 
 @mergeApp.on_message(filters.command(["start"]) & filters.private)
 async def start_handler(c: Client, m: Message):
-    user = UserSettings(m.from_user.id, m.from_user.first_name)
+    user = await UserSettings.load(m.from_user.id, m.from_user.first_name)
 
     if m.from_user.id != int(Config.OWNER):
         if user.allowed is False:
@@ -215,7 +201,7 @@ async def start_handler(c: Client, m: Message):
 )
 async def files_handler(c: Client, m: Message):
     user_id = m.from_user.id
-    user = UserSettings(user_id, m.from_user.first_name)
+    user = await UserSettings.load(user_id, m.from_user.first_name)
     if user_id != int(Config.OWNER):
         if user.allowed is False:
             res = await m.reply_text(
@@ -233,8 +219,9 @@ async def files_handler(c: Client, m: Message):
     if media.file_name is None:
         await m.reply_text("File Not Found")
         return
-    currentFileNameExt = media.file_name.rsplit(sep=".")[-1].lower()
-    if currentFileNameExt in "conf":
+    _, fileInfo = MediaTypeDetector.classify(m)
+    currentFileNameExt = fileInfo["extension"] or ""
+    if currentFileNameExt == "conf":
         await m.reply_text(
             text="**💾 Config file found, Do you want to save it?**",
             reply_markup=InlineKeyboardMarkup(
@@ -274,16 +261,20 @@ async def files_handler(c: Client, m: Message):
                 quote=True,
             )
             return
+        if await rejectByHeader(c, m):
+            return
         editable = await m.reply_text("Please Wait ...", quote=True)
         MessageText = "Okay,\nNow Send Me Next Video or Press **Merge Now** Button!"
 
         if queueDB.get(user_id, None) is None:
             queueDB.update({user_id: {"videos": [], "subtitles": [], "audios": []}})
+            forgetQueueMarkup(user_id)
         if (
             len(queueDB.get(user_id)["videos"]) >= 0
             and len(queueDB.get(user_id)["videos"]) < 10
         ):
             queueDB.get(user_id)["videos"].append(m.id)
+            rememberQueuedFile(user_id, m)
             queueDB.get(m.from_user.id)["subtitles"].append(None)
 
             # LOGGER.info(
@@ -298,6 +289,7 @@ async def files_handler(c: Client, m: Message):
                     ),
                 )
                 replyDB.update({user_id: reply_.id})
+                queueStore.save(user_id)
                 return
             if queueDB.get(user_id, None)["videos"] is None:
                 formatDB.update({user_id: currentFileNameExt})
@@ -312,6 +304,7 @@ async def files_handler(c: Client, m: Message):
                 text=MessageText, reply_markup=InlineKeyboardMarkup(markup)
             )
             replyDB.update({user_id: reply_.id})
+            queueStore.save(user_id)
         elif len(queueDB.get(user_id)["videos"]) > 10:
             markup = await makeButtons(c, m, queueDB)
             await editable.text(
@@ -319,6 +312,9 @@ async def files_handler(c: Client, m: Message):
             )
 
     elif user.merge_mode == 2:
+        queued = (queueDB.get(user_id) or {}).get("videos")
+        if (not queued or currentFileNameExt in AUDIO_EXTENSIONS) and await rejectByHeader(c, m):
+            return
         editable = await m.reply_text("Please Wait ...", quote=True)
         MessageText = (
             "Okay,\nNow Send Me Some More <u>Audios</u> or Press **Merge Now** Button!"
@@ -326,8 +322,10 @@ async def files_handler(c: Client, m: Message):
 
         if queueDB.get(user_id, None) is None:
             queueDB.update({user_id: {"videos": [], "subtitles": [], "audios": []}})
+            forgetQueueMarkup(user_id)
         if len(queueDB.get(user_id)["videos"]) == 0:
             queueDB.get(user_id)["videos"].append(m.id)
+            rememberQueuedFile(user_id, m)
             # if len(queueDB.get(user_id)["videos"])==1:
             reply_ = await editable.edit(
                 text="Now, Send all the audios you want to merge",
@@ -336,12 +334,14 @@ async def files_handler(c: Client, m: Message):
                 ),
             )
             replyDB.update({user_id: reply_.id})
+            queueStore.save(user_id)
             return
         elif (
             len(queueDB.get(user_id)["videos"]) >= 1
             and currentFileNameExt in AUDIO_EXTENSIONS
         ):
             queueDB.get(user_id)["audios"].append(m.id)
+            rememberQueuedFile(user_id, m)
             if replyDB.get(user_id, None) is not None:
                 await c.delete_messages(
                     chat_id=m.chat.id, message_ids=replyDB.get(user_id)
@@ -352,18 +352,23 @@ async def files_handler(c: Client, m: Message):
                 text=MessageText, reply_markup=InlineKeyboardMarkup(markup)
             )
             replyDB.update({user_id: reply_.id})
+            queueStore.save(user_id)
         else:
             await m.reply("This Filetype is not valid")
             return
 
     elif user.merge_mode == 3:
-
+        queued = (queueDB.get(user_id) or {}).get("videos")
+        if (not queued or currentFileNameExt in SUBTITLE_EXTENSIONS) and await rejectByHeader(c, m):
+            return
         editable = await m.reply_text("Please Wait ...", quote=True)
         MessageText = "Okay,\nNow Send Me Some More <u>Subtitles</u> or Press **Merge Now** Button!"
         if queueDB.get(user_id, None) is None:
             queueDB.update({user_id: {"videos": [], "subtitles": [], "audios": []}})
+            forgetQueueMarkup(user_id)
         if len(queueDB.get(user_id)["videos"]) == 0:
             queueDB.get(user_id)["videos"].append(m.id)
+            rememberQueuedFile(user_id, m)
             # if len(queueDB.get(user_id)["videos"])==1:
             reply_ = await editable.edit(
                 text="Now, Send all the subtitles you want to merge",
@@ -372,12 +377,14 @@ async def files_handler(c: Client, m: Message):
                 ),
             )
             replyDB.update({user_id: reply_.id})
+            queueStore.save(user_id)
             return
         elif (
             len(queueDB.get(user_id)["videos"]) >= 1
             and currentFileNameExt in SUBTITLE_EXTENSIONS
         ):
             queueDB.get(user_id)["subtitles"].append(m.id)
+            rememberQueuedFile(user_id, m)
             if replyDB.get(user_id, None) is not None:
                 await c.delete_messages(
                     chat_id=m.chat.id, message_ids=replyDB.get(user_id)
@@ -388,14 +395,26 @@ async def files_handler(c: Client, m: Message):
                 text=MessageText, reply_markup=InlineKeyboardMarkup(markup)
             )
             replyDB.update({user_id: reply_.id})
+            queueStore.save(user_id)
         else:
             await m.reply("This Filetype is not valid")
             return
 
 
+async def rejectByHeader(c: Client, m: Message) -> bool:
+    """
+    Look at the first chunk of a file that passed the extension checks,
+    before queueing a multi-GB download. Replies when it is rejected.
+    """
+    matches, reason = await MediaTypeDetector.check_header(c, m)
+    if not matches:
+        await m.reply_text(f"❌ **File rejected**\n\n{reason}", quote=True)
+    return not matches
+
+
 @mergeApp.on_message(filters.photo & filters.private)
 async def photo_handler(c: Client, m: Message):
-    user = UserSettings(m.chat.id, m.from_user.first_name)
+    user = await UserSettings.load(m.chat.id, m.from_user.first_name)
     # if m.from_user.id != int(Config.OWNER):
     if not user.allowed:
         res = await m.reply_text(
@@ -410,14 +429,18 @@ async def photo_handler(c: Client, m: Message):
     user.set()
     # await database.saveThumb(m.from_user.id, thumbnail)
     LOCATION = f"downloads/{m.from_user.id}_thumb.jpg"
-    await c.download_media(message=m, file_name=LOCATION)
+    cached = await userThumbnail(c, thumbnail)
+    if cached is not None:
+        shutil.copyfile(cached, LOCATION)
+    else:
+        await c.download_media(message=m, file_name=LOCATION)
     await msg.edit_text(text="✅ Custom Thumbnail Saved!")
     del user
 
 
 @mergeApp.on_message(filters.command(["extract"]) & filters.private)
 async def media_extracter(c: Client, m: Message):
-    user = UserSettings(uid=m.from_user.id, name=m.from_user.first_name)
+    user = await UserSettings.load(uid=m.from_user.id, name=m.from_user.first_name)
     if not user.allowed:
         return
     if user.merge_mode == 4:
@@ -520,15 +543,15 @@ async def save_thumbnail(c: Client, m: Message):
 @mergeApp.on_message(filters.command(["showthumbnail"]) & filters.private)
 async def show_thumbnail(c: Client, m: Message):
     try:
-        user = UserSettings(m.from_user.id, m.from_user.first_name)
+        user = await UserSettings.load(m.from_user.id, m.from_user.first_name)
         thumb_id = user.thumbnail
         LOCATION = f"downloads/{str(m.from_user.id)}_thumb.jpg"
-        if os.path.exists(LOCATION):
+        if thumb_id is not None:
+            # the photo is already on Telegram, send it by file id
             await m.reply_photo(
-                photo=LOCATION, caption="🖼️ Your custom thumbnail", quote=True
+                photo=str(thumb_id), caption="🖼️ Your custom thumbnail", quote=True
             )
-        elif thumb_id is not None :
-            await c.download_media(message=str(thumb_id), file_name=LOCATION)
+        elif os.path.exists(LOCATION):
             await m.reply_photo(
                 photo=LOCATION, caption="🖼️ Your custom thumbnail", quote=True
             )
@@ -543,7 +566,7 @@ async def show_thumbnail(c: Client, m: Message):
 @mergeApp.on_message(filters.command(["deletethumbnail"]) & filters.private)
 async def delete_thumbnail(c: Client, m: Message):
     try:
-        user = UserSettings(m.from_user.id, m.from_user.first_name)
+        user = await UserSettings.load(m.from_user.id, m.from_user.first_name)
         user.thumbnail = None
         user.set()
         if os.path.exists(f"downloads/{str(m.from_user.id)}"):
@@ -554,6 +577,60 @@ async def delete_thumbnail(c: Client, m: Message):
     except Exception as err:
         await m.reply_text(text="❌ Custom thumbnail not found", quote=True)
 
+@mergeApp.on_message(filters.command(["rclone"]) & filters.private)
+async def rclone_settings(c: Client, m: Message):
+    user_id = m.from_user.id
+    user = await UserSettings.load(user_id, m.from_user.first_name)
+    if not user.allowed:
+        await m.reply_text(
+            text=f"Hi **{m.from_user.first_name}**\n\n 🛡️ Unfortunately you can't use me\n\n**Contact: 🈲 @{Config.OWNER_USERNAME}** ",
+            quote=True,
+        )
+        return
+    usage = (
+        "**Command:**\n  `/rclone [remote] [stream=off] [chunk_size=64M] [transfers=4] [buffer_size=32M]`\n\n"
+        "**Usage:**\n  `remote`: Remote to upload to\n  `stream`: `on` pipes merges and extracts straight to the remote\n  Use `default` as a value to reset it, or alone to reset all of them"
+    )
+    args = m.text.split()[1:]
+    if args:
+        remote = None
+        tuning = {}
+        for arg in args:
+            key, sep, value = arg.partition("=")
+            if sep:
+                tuning[key] = None if value == "default" else value
+            elif key == "default":
+                # reset every value, never a remote name
+                tuning.update(dict.fromkeys(TUNING_FLAGS), stream=None)
+            else:
+                remote = key
+        try:
+            # "" when not given, None for default, which is off
+            stream = tuning.pop("stream", "")
+            if stream not in ("", None, "on", "off"):
+                raise ValueError("`stream` must be on or off")
+            rcloneRegistry.select(
+                user_id, remote, stream=None if stream == "" else stream == "on", **tuning
+            )
+        except ValueError as e:
+            await m.reply_text(f"**{e}**\n\n{usage}", quote=True)
+            return
+    remotes = rcloneRegistry.remotes(user_id)
+    if not remotes:
+        await m.reply_text("**No rclone config saved.**\nSend your `rclone.conf` first.", quote=True)
+        return
+    chosen = rcloneRegistry.remote(user_id)
+    text = "**☁️ Rclone remotes**\n\n" + "\n".join(
+        f"{'✅' if name == chosen else '▫️'} `{name}` ({type_})"
+        for name, type_ in remotes.items()
+    )
+    text += f"\n\n**Streaming upload:** `{'on' if rcloneRegistry.streaming(user_id) else 'off'}`"
+    text += "\n\n**Upload tuning**\n" + "\n".join(
+        f"  `{key}`: `{value}`" for key, value in rcloneRegistry.tuning(user_id).items()
+    )
+    await m.reply_text(f"{text}\n\n{usage}", quote=True)
+
+
 @mergeApp.on_message(filters.command(["ban","unban"]) & filters.private)
 async def ban_user(c:Client,m:Message):
     incoming=m.text.split(' ')[0]
@@ -566,10 +643,11 @@ async def ban_user(c:Client,m:Message):
                 else:
                     try:
                         user_obj: User = await c.get_users(abuser_id)
-                        udata  = UserSettings(uid=abuser_id,name=user_obj.first_name)
+                        udata  = await UserSettings.load(uid=abuser_id,name=user_obj.first_name)
                         udata.banned=True
                         udata.allowed=False
                         udata.set()
+                        UserSettings.invalidate(abuser_id)
                         await m.reply_text(f"Pooof, {user_obj.first_name} has been **BANNED**",quote=True)
                         acknowledgement = f"""
 Dear {user_obj.first_name},
@@ -602,10 +680,11 @@ Your account can be released only by @{Config.OWNER_USERNAME}."""
                 else:
                     try:
                         user_obj: User = await c.get_users(abuser_id)
-                        udata  = UserSettings(uid=abuser_id,name=user_obj.first_name)
+                        udata  = await UserSettings.load(uid=abuser_id,name=user_obj.first_name)
                         udata.banned=False
                         udata.allowed=True
                         udata.set()
+                        UserSettings.invalidate(abuser_id)
                         await m.reply_text(f"Pooof, {user_obj.first_name} has been **UN_BANNED**",quote=True)
                         release_notice = f"""
 Good news {user_obj.first_name}, the ban has been uplifted on your account. You're free as a bird!"""
@@ -637,6 +716,12 @@ async def showQueue(c: Client, cb: CallbackQuery):
 
 
 async def delete_all(root):
+    # every cancel and finished merge clears the user's folder with this,
+    # their queue is gone too so its keyboard and saved copy can go
+    user_id = os.path.basename(os.path.normpath(root))
+    forgetQueueMarkup(user_id)
+    if user_id.isdigit():
+        queueStore.drop(int(user_id))
     try:
         shutil.rmtree(root)
     except Exception as e:
@@ -644,108 +729,66 @@ async def delete_all(root):
 
 
 async def makeButtons(bot: Client, m: Message, db: dict):
-    markup = []
-    user = UserSettings(m.chat.id, m.chat.first_name)
+    user = await UserSettings.load(m.chat.id, m.chat.first_name)
+    queue = db.get(m.chat.id)
     if user.merge_mode == 1:
-        for i in await bot.get_messages(
-            chat_id=m.chat.id, message_ids=db.get(m.chat.id)["videos"]
-        ):
-            media = i.video or i.document or None
-            if media is None:
-                continue
-            else:
-                markup.append(
-                    [
-                        InlineKeyboardButton(
-                            f"{media.file_name}",
-                            callback_data=f"showFileName_{i.id}",
-                        )
-                    ]
-                )
-
+        ids = list(queue["videos"])
     elif user.merge_mode == 2:
-        msgs: list[Message] = await bot.get_messages(
-            chat_id=m.chat.id, message_ids=db.get(m.chat.id)["audios"]
-        )
-        msgs.insert(
-            0,
-            await bot.get_messages(
-                chat_id=m.chat.id, message_ids=db.get(m.chat.id)["videos"][0]
-            ),
-        )
-        for i in msgs:
-            media = i.audio or i.document or i.video or None
-            if media is None:
-                continue
-            else:
-                markup.append(
-                    [
-                        InlineKeyboardButton(
-                            f"{media.file_name}",
-                            callback_data=f"tryotherbutton",
-                        )
-                    ]
-                )
-
+        ids = queue["videos"][:1] + queue["audios"]
     elif user.merge_mode == 3:
-        msgs: list[Message] = await bot.get_messages(
-            chat_id=m.chat.id, message_ids=db.get(m.chat.id)["subtitles"]
-        )
-        msgs.insert(
-            0,
-            await bot.get_messages(
-                chat_id=m.chat.id, message_ids=db.get(m.chat.id)["videos"][0]
-            ),
-        )
-        for i in msgs:
-            media = i.video or i.document or None
-
-            if media is None:
-                continue
-            else:
-                markup.append(
-                    [
-                        InlineKeyboardButton(
-                            f"{media.file_name}",
-                            callback_data=f"tryotherbutton",
-                        )
-                    ]
+        ids = queue["videos"][:1] + [i for i in queue["subtitles"] if i is not None]
+    else:
+        ids = []
+    meta = await queuedFileMeta(bot, m.chat.id, ids)
+
+    cached = queueMarkup.get(m.chat.id)
+    if cached is None or cached[0] != user.merge_mode or ids[: len(cached[1])] != cached[1]:
+        cached = (user.merge_mode, [], [])
+        queueMarkup[m.chat.id] = cached
+    _, rendered, rows = cached
+    for i in ids[len(rendered) :]:
+        rendered.append(i)
+        name = meta.get(str(i), {}).get("name")
+        if name is None:
+            continue
+        rows.append(
+            [
+                InlineKeyboardButton(
+                    f"{name}",
+                    callback_data=f"showFileName_{i}"
+                    if user.merge_mode == 1
+                    else "tryotherbutton",
                 )
-
+            ]
+        )
+    markup = list(rows)
     markup.append([InlineKeyboardButton("🔗 Merge Now", callback_data="merge")])
     markup.append([InlineKeyboardButton("💥 Clear Files", callback_data="cancel")])
     return markup
 
 
-LOGCHANNEL = Config.LOGCHANNEL
-try:
-    if Config.USER_SESSION_STRING is None:
-        raise KeyError
-    LOGGER.info("Starting USER Session")
-    userBot = Client(
-        name="merge-bot-user",
-        session_string=Config.USER_SESSION_STRING,
-        no_updates=True,
+async def bootUserSession():
+    await userSession.start()
+    await userBot.send_message(
+        chat_id=int(LOGCHANNEL),
+        text="Bot booted with Premium Account,\n\n  Thanks for using <a href='https://github.com/yashoswalyo/merge-bot'>this repo</a>",
+        disable_web_page_preview=True,
     )
-
-except KeyError:
-    userBot = None
-    LOGGER.warning("No User Session, Default Bot session will be used")
+    user = await userBot.get_me()
+    Config.IS_PREMIUM = user.is_premium
 
 
 if __name__ == "__main__":
+    queueStore.init()
+    queueStore.restore()
+    queueStore.reclaimLocks()
+    queueStore.start(mergeApp.loop)
     # with mergeApp:
     #     bot:User = mergeApp.get_me()
     #     bot_username = bot.username
     try:
-        with userBot:
-            userBot.send_message(
-                chat_id=int(LOGCHANNEL),
-                text="Bot booted with Premium Account,\n\n  Thanks for using <a href='https://github.com/yashoswalyo/merge-bot'>this repo</a>",
-                disable_web_page_preview=True,
-            )
-            user = userBot.get_me()
-            Config.IS_PREMIUM = user.is_premium
+        # stays connected for the bot's lifetime, see helpers/user_session.py
+        userBot.loop.run_until_complete(bootUserSession())
     except Exception as err:
         LOGGER.error(f"{err}")
         Config.IS_PREMIUM = False
@@ -14,3 +14,28 @@ class Config(object):
     USER_SESSION_STRING = os.environ.get("USER_SESSION_STRING", None)
     IS_PREMIUM = False
     MODES = ["video-video", "video-audio", "video-subtitle", "extract-streams"]
+    FFMPEG_CONCURRENCY = int(os.environ.get("FFMPEG_CONCURRENCY", os.cpu_count() or 1))
+    DOWNLOAD_SLOTS = int(os.environ.get("DOWNLOAD_SLOTS", 4))
+    PROCESS_SLOTS = int(os.environ.get("PROCESS_SLOTS", 2))
+    UPLOAD_SLOTS = int(os.environ.get("UPLOAD_SLOTS", 4))
+    JOBS_PER_USER = int(os.environ.get("JOBS_PER_USER", 1))
+    DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 3))
+    CHUNKED_DOWNLOAD_MIN_SIZE = int(os.environ.get("CHUNKED_DOWNLOAD_MIN_SIZE", 200 * 1024 * 1024))
+    CHUNKED_DOWNLOAD_PARTS = int(os.environ.get("CHUNKED_DOWNLOAD_PARTS", 4))
+    QUEUE_DB_PATH = os.environ.get("QUEUE_DB_PATH", "userdata/queue.db")
+    QUEUE_SYNC_INTERVAL = int(os.environ.get("QUEUE_SYNC_INTERVAL", 30))
+    BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+    BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 10))
+    BROADCAST_STATUS_INTERVAL = int(os.environ.get("BROADCAST_STATUS_INTERVAL", 10))
+    UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 3))
+    USER_UPLOAD_WORKERS = int(os.environ.get("USER_UPLOAD_WORKERS", 2))
+    USER_SESSION_HEALTH_INTERVAL = int(os.environ.get("USER_SESSION_HEALTH_INTERVAL", 60))
+    RCLONE_DRIVE_CHUNK_SIZE = os.environ.get("RCLONE_DRIVE_CHUNK_SIZE", "64M")
+    RCLONE_TRANSFERS = int(os.environ.get("RCLONE_TRANSFERS", 4))
+    RCLONE_BUFFER_SIZE = os.environ.get("RCLONE_BUFFER_SIZE", "32M")
+    RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "userdata/results.db")
+    RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 5000))
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    SETTINGS_CACHE_TTL = int(os.environ.get("SETTINGS_CACHE_TTL", 300))
+    SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", 1000))
+    SETTINGS_FLUSH_INTERVAL = int(os.environ.get("SETTINGS_FLUSH_INTERVAL", 5))
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from collections import deque
+
+from pyrogram.errors import (
+    FloodWait,
+    InputUserDeactivated,
+    PeerIdInvalid,
+    UserIsBlocked,
+)
+from pyrogram.types import Message
+
+from __init__ import BROADCAST_MSG, LOGGER
+from config import Config
+from helpers import database
+
+
+class TokenBucket(object):
+    """Allows `rate` sends per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity, self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class Broadcast(object):
+    """
+    Copies one message to every user with concurrent senders.
+
+    Sends are paced by a token bucket and a FloodWait pauses every sender.
+    Users are processed in `_id` order and the highest id below which
+    everything is done is checkpointed to Mongo, so an interrupted
+    broadcast resumes where it stopped. Users that blocked the bot or no
+    longer exist are deleted in one go at the end.
+    """
+
+    def __init__(self, msg: Message, status: Message, users: list, state: dict = None):
+        self._msg = msg
+        self._status = status
+        self._users = users
+        state = state or {}
+        self._total = state.get("total", len(users))
+        self._success = state.get("success", 0)
+        self._failed = state.get("failed", 0)
+        self._watermark = state.get("watermark")
+        self._dead = list(state.get("dead", []))
+        self._bucket = TokenBucket(Config.BROADCAST_RATE, Config.BROADCAST_WORKERS)
+        self._paused_until = 0.0
+        # ids in dispatch order, True once done, to advance the watermark
+        self._pending = {}
+        self._order = deque()
+
+    async def _send(self, uid: int):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._bucket.acquire()
+            try:
+                if uid != int(Config.OWNER):
+                    await self._msg.copy(chat_id=uid)
+                return True
+            except FloodWait as e:
+                LOGGER.warning(f"Broadcast FloodWait {e.value}s")
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + e.value + 1
+                )
+            except (InputUserDeactivated, UserIsBlocked, PeerIdInvalid) as e:
+                LOGGER.info(f"{uid} : {type(e).__name__}")
+                self._dead.append(uid)
+                return False
+            except Exception as err:
+                LOGGER.warning(f"{uid} : {err}")
+                return False
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            uid = await queue.get()
+            try:
+                if await self._send(uid):
+                    self._success += 1
+                else:
+                    self._failed += 1
+            finally:
+                self._pending[uid] = True
+                self._advance()
+                queue.task_done()
+
+    def _advance(self):
+        while self._order and self._pending.get(self._order[0]):
+            uid = self._order.popleft()
+            del self._pending[uid]
+            self._watermark = uid
+
+    def _state(self) -> dict:
+        return {
+            "chat_id": self._msg.chat.id,
+            "message_id": self._msg.id,
+            "watermark": self._watermark,
+            "total": self._total,
+            "success": self._success,
+            "failed": self._failed,
+            "dead": self._dead,
+        }
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(Config.BROADCAST_STATUS_INTERVAL)
+            await self._checkpoint()
+
+    async def _checkpoint(self):
+        try:
+            await database.saveBroadcastCheckpoint(self._state())
+            await self._status.edit_text(
+                text=BROADCAST_MSG.format(self._total, self._success)
+            )
+        except Exception as e:
+            LOGGER.info(e)
+
+    async def run(self):
+        queue = asyncio.Queue(maxsize=Config.BROADCAST_WORKERS * 2)
+        workers = [
+            asyncio.ensure_future(self._worker(queue))
+            for _ in range(Config.BROADCAST_WORKERS)
+        ]
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            for user in self._users:
+                self._order.append(user["_id"])
+                self._pending[user["_id"]] = False
+                await queue.put(user["_id"])
+            await queue.join()
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+        removed = await database.deleteUsers(self._dead)
+        LOGGER.info(f"Broadcast done, removed {removed} dead users")
+        await database.clearBroadcastCheckpoint()
+        await self._status.edit_text(
+            text=BROADCAST_MSG.format(self._total, self._success)
+            + f"**Failed: {str(self._failed)}**\n\n__🤓 Broadcast completed sucessfully__",
+        )
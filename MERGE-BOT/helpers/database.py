@@ -1,13 +1,30 @@
-from pymongo import MongoClient
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient, ReplaceOne
 from pymongo.errors import DuplicateKeyError
 from pyrogram.types import CallbackQuery
 from config import Config
 from __init__ import LOGGER, MERGE_MODE
+from helpers.rclone_config import rcloneRegistry
 
 
 class Database(object):
-    client = MongoClient(Config.DATABASE_URL)
+    client = MongoClient(Config.DATABASE_URL, maxPoolSize=Config.DB_POOL_SIZE)
     mergebot = client.MergeBot
+    # pymongo blocks, so async callers hop onto this bounded pool instead
+    executor = ThreadPoolExecutor(
+        max_workers=Config.DB_POOL_SIZE, thread_name_prefix="mongo"
+    )
+
+
+async def _run(func, *args, **kwargs):
+    """Run a blocking pymongo call on the database executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        Database.executor, functools.partial(func, *args, **kwargs)
+    )
 
 
 async def addUser(uid, fname, lname):
@@ -16,7 +33,7 @@ async def addUser(uid, fname, lname):
             "_id": uid,
             "name": f"{fname} {lname}",
         }
-        Database.mergebot.users.insert_one(userDetails)
+        await _run(Database.mergebot.users.insert_one, userDetails)
         LOGGER.info(f"New user added id={uid}\n{fname} {lname} \n")
     except DuplicateKeyError:
         LOGGER.info(f"Duplicate Entry Found for id={uid}\n{fname} {lname} \n")
@@ -24,16 +41,17 @@ async def addUser(uid, fname, lname):
 
 
 async def broadcast():
-    a = Database.mergebot.mergeSettings.find({})
+    a = await _run(lambda: list(Database.mergebot.mergeSettings.find({})))
     return a
 
 
 async def allowUser(uid, fname, lname):
     try:
-        a = Database.mergebot.allowedUsers.insert_one(
+        a = await _run(
+            Database.mergebot.allowedUsers.insert_one,
             {
                 "_id": uid,
-            }
+            },
         )
     except DuplicateKeyError:
         LOGGER.info(f"Duplicate Entry Found for id={uid}\n{fname} {lname} \n")
@@ -41,7 +59,7 @@ async def allowUser(uid, fname, lname):
 
 
 async def allowedUser(uid):
-    a = Database.mergebot.allowedUsers.find_one({"_id": uid})
+    a = await _run(Database.mergebot.allowedUsers.find_one, {"_id": uid})
     try:
         if uid == a["_id"]:
             return True
@@ -51,42 +69,105 @@ async def allowedUser(uid):
 
 async def saveThumb(uid, fid):
     try:
-        Database.mergebot.thumbnail.insert_one({"_id": uid, "thumbid": fid})
+        await _run(Database.mergebot.thumbnail.insert_one, {"_id": uid, "thumbid": fid})
     except DuplicateKeyError:
-        Database.mergebot.thumbnail.replace_one({"_id": uid}, {"thumbid": fid})
+        await _run(
+            Database.mergebot.thumbnail.replace_one, {"_id": uid}, {"thumbid": fid}
+        )
 
 
 async def delThumb(uid):
-    Database.mergebot.thumbnail.delete_many({"_id": uid})
+    await _run(Database.mergebot.thumbnail.delete_many, {"_id": uid})
     return True
 
 
 async def getThumb(uid):
-    res = Database.mergebot.thumbnail.find_one({"_id": uid})
+    res = await _run(Database.mergebot.thumbnail.find_one, {"_id": uid})
     return res["thumbid"]
 
 
+def _deleteSettings(uids: list):
+    # helpers.utils imports this module, so its cache is looked up here
+    from helpers.utils import settingsCache
+
+    # a cached or unflushed document would upsert the user right back
+    settingsCache.forget(uids)
+    return Database.mergebot.mergeSettings.delete_many({"_id": {"$in": uids}})
+
+
 async def deleteUser(uid):
-    Database.mergebot.mergeSettings.delete_many({"_id": uid})
+    await _run(_deleteSettings, [uid])
+
+
+async def deleteUsers(uids: list):
+    if not uids:
+        return 0
+    res = await _run(_deleteSettings, list(uids))
+    return res.deleted_count
+
+
+async def getBroadcastUsers(after=None):
+    """Users in `_id` order, only those after `after` when resuming"""
+    query = {} if after is None else {"_id": {"$gt": after}}
+    return await _run(
+        lambda: list(
+            Database.mergebot.mergeSettings.find(query, {"name": 1}).sort("_id", 1)
+        )
+    )
+
+
+async def saveBroadcastCheckpoint(state: dict):
+    await _run(
+        Database.mergebot.broadcasts.replace_one,
+        {"_id": "checkpoint"},
+        state,
+        upsert=True,
+    )
+
+
+async def getBroadcastCheckpoint():
+    return await _run(Database.mergebot.broadcasts.find_one, {"_id": "checkpoint"})
+
+
+async def clearBroadcastCheckpoint():
+    await _run(Database.mergebot.broadcasts.delete_many, {"_id": "checkpoint"})
+
+
+# uid -> Telegram file id of the user's rclone.conf
+_rcloneFileIds = {}
 
 
 async def addUserRcloneConfig(cb: CallbackQuery, fileId):
+    _rcloneFileIds.pop(cb.from_user.id, None)
     try:
         await cb.message.edit("Adding file to DB")
         uid = cb.from_user.id
-        Database.mergebot.rcloneData.insert_one({"_id": uid, "rcloneFileId": fileId})
+        await _run(
+            Database.mergebot.rcloneData.insert_one,
+            {"_id": uid, "rcloneFileId": fileId},
+        )
     except Exception as err:
         LOGGER.info("Updating rclone")
         await cb.message.edit("Updating file in DB")
         uid = cb.from_user.id
-        Database.mergebot.rcloneData.replace_one({"_id": uid}, {"rcloneFileId": fileId})
+        await _run(
+            Database.mergebot.rcloneData.replace_one,
+            {"_id": uid},
+            {"rcloneFileId": fileId},
+        )
+    _rcloneFileIds[cb.from_user.id] = fileId
+    # the saved file replaces the config the registry parsed before
+    rcloneRegistry.invalidate(cb.from_user.id)
     await cb.message.edit("Done")
     return
 
 
 async def getUserRcloneConfig(uid):
+    if uid in _rcloneFileIds:
+        return _rcloneFileIds[uid]
     try:
-        res = Database.mergebot.rcloneData.find_one({"_id": uid})
+        res = await _run(Database.mergebot.rcloneData.find_one, {"_id": uid})
+        _rcloneFileIds[uid] = res["rcloneFileId"]
         return res["rcloneFileId"]
     except Exception as err:
         return None
@@ -101,6 +182,10 @@ def getUserMergeSettings(uid: int):
         return None
 
 
+async def loadUserMergeSettings(uid: int):
+    return await _run(getUserMergeSettings, uid)
+
+
 def setUserMergeSettings(uid: int, name: str, mode, edit_metadata, banned, allowed, thumbnail):
     modes = Config.MODES
     if uid:
@@ -165,6 +250,30 @@ def setUserMergeSettings(uid: int, name: str, mode, edit_metadata, banned, allow
     LOGGER.info(MERGE_MODE)
 
 
+def bulkSetUserMergeSettings(documents: list):
+    """
+    Upsert many merge settings documents in a single round-trip.
+
+    Parameters:
+    - `documents`: List of settings documents, each carrying its `_id`.
+    """
+    if not documents:
+        return
+    requests = []
+    for doc in documents:
+        if not doc["_id"]:
+            continue
+        replacement = {k: v for k, v in doc.items() if k != "_id"}
+        requests.append(ReplaceOne({"_id": doc["_id"]}, replacement, upsert=True))
+    if not requests:
+        return
+    result = Database.mergebot.mergeSettings.bulk_write(requests, ordered=False)
+    LOGGER.info(
+        f"Flushed {len(requests)} user settings "
+        f"(upserted={result.upserted_count}, modified={result.modified_count})"
+    )
+
+
 def enableMetadataToggle(uid: int, value: bool):
 
     1
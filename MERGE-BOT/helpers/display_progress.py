@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 # (c) Shrimadhav U K | gautamajay52
 
+import asyncio
+import functools
 import logging
 import math
 import os
 import time
+from collections import OrderedDict
 
 from pyrogram.errors.exceptions import FloodWait
 from __init__ import (
@@ -25,95 +28,204 @@ logger = logging.getLogger(__name__)
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 
+class ProgressDispatcher(object):
+    """
+    Rate limits progress edits per chat.
+
+    Every chat gets at most one edit per `interval` seconds. Updates that
+    arrive in between only replace the pending state of their message, and
+    the next update in that chat to find the window open sends the message
+    that has waited longest. Nothing is edited outside a progress callback,
+    and a pending update not refreshed within `interval` is taken as a
+    finished transfer and dropped, so a late edit can't overwrite the
+    final text of a message. The final update of a transfer is always
+    sent, whatever the window, so the message never stays at a stale
+    percentage.
+    FloodWait closes the chat's window for its duration instead of
+    blocking the loop.
+    """
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        # chat_id -> monotonic time of the next allowed edit
+        self._next = {}
+        # chat_id -> OrderedDict(message_id -> (message, render, stamp)), oldest first
+        self._pending = {}
+
+    async def submit(self, message: Message, render, final: bool = False):
+        """
+        Queue the latest progress of `message` and send one edit if the chat
+        allows it.
+
+        Parameters:
+        - `message`: Editable Message showing the progress.
+        - `render`: Callable returning (text, reply_markup), only called
+          when the edit is really sent.
+        - `final`: This is the transfer's last update, send it now.
+
+        returns: True if an edit was sent
+        """
+        if final:
+            return await self._flush(message, render)
+        chat_id = message.chat.id
+        now = time.monotonic()
+        pending = self._pending.setdefault(chat_id, OrderedDict())
+        pending[message.id] = (message, render, now)
+        if now < self._next.get(chat_id, 0.0):
+            return False
+        while True:
+            mes_id, (target, render, stamp) = pending.popitem(last=False)
+            if now - stamp <= self._interval:
+                break
+        if not pending:
+            del self._pending[chat_id]
+        # claim the window before awaiting so concurrent callbacks back off
+        self._next[chat_id] = now + self._interval
+        text, reply_markup = render()
+        try:
+            if not target.photo:
+                await target.edit_text(text=text, reply_markup=reply_markup)
+            else:
+                await target.edit_caption(caption=text)
+            return True
+        except FloodWait as fd:
+            logger.warning(f"{fd}")
+            self._next[chat_id] = time.monotonic() + fd.value
+            pending = self._pending.setdefault(chat_id, OrderedDict())
+            if mes_id not in pending:
+                pending[mes_id] = (target, render, stamp)
+                pending.move_to_end(mes_id, last=False)
+        except Exception as ou:
+            logger.info(ou)
+        return False
+
+    async def _flush(self, message: Message, render):
+        self.discard(message)
+        chat_id = message.chat.id
+        text, reply_markup = render()
+        while True:
+            self._next[chat_id] = time.monotonic() + self._interval
+            try:
+                if not message.photo:
+                    await message.edit_text(text=text, reply_markup=reply_markup)
+                else:
+                    await message.edit_caption(caption=text)
+                return True
+            except FloodWait as fd:
+                logger.warning(f"{fd}")
+                self._next[chat_id] = time.monotonic() + fd.value
+                await asyncio.sleep(fd.value)
+            except Exception as ou:
+                logger.info(ou)
+                return False
+
+    def discard(self, message: Message):
+        """Drop the pending update of a finished `message`"""
+        pending = self._pending.get(message.chat.id)
+        if pending is not None:
+            pending.pop(message.id, None)
+            if not pending:
+                del self._pending[message.chat.id]
+
+
+progressDispatcher = ProgressDispatcher(float(EDIT_SLEEP_TIME_OUT))
+
+
 class Progress:
     def __init__(self, from_user, client, mess: Message):
         self._from_user = from_user
         self._client = client
         self._mess = mess
         self._cancelled = False
-
-    @property
-    def is_cancelled(self):
-        chat_id = self._mess.chat.id
-        mes_id = self._mess.id
-        if gDict[chat_id] and mes_id in gDict[chat_id]:
-            self._cancelled = True
-        return self._cancelled
-
-    async def progress_for_pyrogram(self, current, total, ud_type, start, count=""):
-        chat_id = self._mess.chat.id
-        mes_id = self._mess.id
-        from_user = self._from_user
-        now = time.time()
-        diff = now - start
-        reply_markup = InlineKeyboardMarkup(
+        self._reply_markup = InlineKeyboardMarkup(
             [
                 [
                     InlineKeyboardButton(
                         "⛔ Cancel ⛔",
                         callback_data=(
-                            f"gUPcancel/{chat_id}/{mes_id}/{from_user}"
+                            f"gUPcancel/{mess.chat.id}/{mess.id}/{from_user}"
                         ).encode("UTF-8"),
                     )
                 ]
             ]
         )
+
+    @property
+    def is_cancelled(self):
+        chat_id = self._mess.chat.id
+        mes_id = self._mess.id
+        if gDict[chat_id] and mes_id in gDict[chat_id]:
+            self._cancelled = True
+        return self._cancelled
+
+    async def progress_for_pyrogram(self, current, total, ud_type, start, count=""):
         if self.is_cancelled:
             LOGGER.info("stopping ")
+            progressDispatcher.discard(self._mess)
             await self._mess.edit(
                 f"⛔ **Cancelled** ⛔ \n\n `{ud_type}` ({humanbytes(total)})"
             )
             await self._client.stop_transmission()
 
-        if round(diff % float(EDIT_SLEEP_TIME_OUT)) == 0 or current == total:
-            # if round(current / total * 100, 0) % 5 == 0:
-            percentage = current * 100 / total
-            speed = current / diff
-            elapsed_time = round(diff) * 1000
-            time_to_completion = round((total - current) / speed) * 1000
-            estimated_total_time = time_to_completion
-
-            elapsed_time = TimeFormatter(milliseconds=elapsed_time)
-            estimated_total_time = TimeFormatter(milliseconds=estimated_total_time)
-
-            progress = "\n<code>[{0}{1}] {2}%</code>\n".format(
-                "".join(
-                    [FINISHED_PROGRESS_STR for i in range(math.floor(percentage / 5))]
-                ),
-                "".join(
-                    [
-                        UN_FINISHED_PROGRESS_STR
-                        for i in range(20 - math.floor(percentage / 5))
-                    ]
-                ),
-                round(percentage, 2),
-            )
-            # cpu = "{psutil.cpu_percent()}%"
-            tmp = (
-                progress
-                + "\n**⌧ Total 🗃:**` 〚{1}〛`\n**⌧ Done ✅ :**` 〚{0}〛`\n**⌧ Speed 📊 :** ` 〚{2}/s〛`\n**⌧ ETA 🔃 :**` 〚{3}〛`\n {4}".format(
-                    humanbytes(current),
-                    humanbytes(total),
-                    humanbytes(speed),
-                    # elapsed_time if elapsed_time != '' else "0 s",
-                    estimated_total_time if estimated_total_time != "" else "0 s",
-                    count
-                )
+        await progressDispatcher.submit(
+            self._mess,
+            functools.partial(
+                self._render, current, total, ud_type, start, time.time(), count
+            ),
+            final=bool(total) and current >= total,
+        )
+
+    def _render(self, current, total, ud_type, start, now, count):
+        diff = max(now - start, 0.001)
+        percentage = current * 100 / total if total else 0
+        speed = current / diff
+        time_to_completion = round((total - current) / speed) * 1000 if speed else 0
+        estimated_total_time = TimeFormatter(milliseconds=time_to_completion)
+
+        progress = "\n<code>[{0}{1}] {2}%</code>\n".format(
+            FINISHED_PROGRESS_STR * math.floor(percentage / 5),
+            UN_FINISHED_PROGRESS_STR * (20 - math.floor(percentage / 5)),
+            round(percentage, 2),
+        )
+        # cpu = "{psutil.cpu_percent()}%"
+        tmp = (
+            progress
+            + "\n**⌧ Total 🗃:**` 〚{1}〛`\n**⌧ Done ✅ :**` 〚{0}〛`\n**⌧ Speed 📊 :** ` 〚{2}/s〛`\n**⌧ ETA 🔃 :**` 〚{3}〛`\n {4}".format(
+                humanbytes(current),
+                humanbytes(total),
+                humanbytes(speed),
+                estimated_total_time if estimated_total_time != "" else "0 s",
+                count
             )
-            try:
-                if not self._mess.photo:
-                    await self._mess.edit_text(
-                        text="{}\n {}".format(ud_type, tmp), reply_markup=reply_markup
-                    )
-                else:
-                    await self._mess.edit_caption(
-                        caption="{}\n {}".format(ud_type, tmp)
-                    )
-            except FloodWait as fd:
-                logger.warning(f"{fd}")
-                time.sleep(fd.x)
-            except Exception as ou:
-                logger.info(ou)
+        )
+        return "{}\n {}".format(ud_type, tmp), self._reply_markup
+
+
+class BatchProgress(object):
+    """Folds the progress of parallel transfers into one status message"""
+
+    def __init__(self, progress: Progress, total: int, count: int, ud_type: str, verb: str):
+        self._progress = progress
+        self._total = max(total, 1)
+        self._count = count
+        self._ud_type = ud_type
+        self._verb = verb
+        self._received = {}
+        self._finished = 0
+        self._start = time.time()
+
+    async def update(self, key, current):
+        self._received[key] = current
+        await self._progress.progress_for_pyrogram(
+            min(sum(self._received.values()), self._total),
+            self._total,
+            self._ud_type,
+            self._start,
+            f"\n**{self._verb}: {self._finished}/{self._count}**",
+        )
+
+    def finish(self):
+        self._finished += 1
 
 
 def humanbytes(size):
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import os
+
+from pyrogram import Client, StopTransmission
+from pyrogram.errors import FloodWait
+from pyrogram.types import Message
+
+from __init__ import LOGGER
+from config import Config
+from helpers.display_progress import BatchProgress, Progress
+from helpers.queue_store import queueStore
+from helpers.scheduler import scheduler
+from helpers.user_session import LOGCHANNEL, userBot, userSession
+
+# pyrogram streams media in 1 MiB chunks, offsets and limits count chunks
+STREAM_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+
+
+def _downloadPath(user_id: int, message: Message) -> str:
+    media = message.video or message.document or message.audio
+    return f"downloads/{str(user_id)}/{str(message.id)}/{media.file_name}"
+
+
+async def _downloadChunked(message: Message, file_name: str, file_size: int, on_progress):
+    """
+    Download `message` through the premium session with several part
+    requests running in parallel, each writing its own byte range.
+    """
+    await userSession.ensure()
+    # the user session can't see the bot's private chats, go through LOGCHANNEL
+    copied = await message.copy(chat_id=int(LOGCHANNEL))
+    try:
+        source = await userBot.get_messages(int(LOGCHANNEL), copied.id)
+        total_chunks = math.ceil(file_size / STREAM_CHUNK_SIZE)
+        per_part = math.ceil(total_chunks / Config.CHUNKED_DOWNLOAD_PARTS)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, file_size)
+            received = [0] * Config.CHUNKED_DOWNLOAD_PARTS
+
+            async def fetch(part: int):
+                first = part * per_part
+                position = first * STREAM_CHUNK_SIZE
+                async for chunk in userBot.stream_media(
+                    source, offset=first, limit=per_part
+                ):
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+                    received[part] += len(chunk)
+                    await on_progress(sum(received))
+
+            fetches = [
+                asyncio.ensure_future(fetch(part))
+                for part in range(Config.CHUNKED_DOWNLOAD_PARTS)
+                if part * per_part < total_chunks
+            ]
+            try:
+                await asyncio.gather(*fetches)
+            except BaseException:
+                # no fetch may write to fd once it is closed or reused
+                for task in fetches:
+                    task.cancel()
+                await asyncio.gather(*fetches, return_exceptions=True)
+                os.close(fd)
+                fd = None
+                os.remove(file_name)
+                raise
+        finally:
+            if fd is not None:
+                os.close(fd)
+    finally:
+        await copied.delete()
+    return file_name
+
+
+async def downloadMessage(c: Client, message: Message, user_id: int, on_progress=None):
+    """
+    Download one queued message, sleeping through FloodWaits.
+
+    returns: downloaded file path or None
+    """
+    media = message.video or message.document or message.audio
+    file_name = _downloadPath(user_id, message)
+    finished = queueStore.downloaded(user_id, message.id, media.file_size)
+    if finished is not None:
+        LOGGER.info(f"Reusing finished download {finished}")
+        return finished
+
+    async def progress(current, total=None):
+        if on_progress is not None:
+            await on_progress(message.id, current)
+
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            if (
+                userBot is not None
+                and LOGCHANNEL is not None
+                and media.file_size >= Config.CHUNKED_DOWNLOAD_MIN_SIZE
+            ):
+                path = await _downloadChunked(
+                    message, file_name, media.file_size, progress
+                )
+            else:
+                path = await c.download_media(
+                    message=message, file_name=file_name, progress=progress
+                )
+            if path is not None:
+                queueStore.markDownloaded(user_id, message.id, path, media.file_size)
+            return path
+        except StopTransmission:
+            LOGGER.info(f"Download of {message.id} cancelled")
+            return None
+        except FloodWait as e:
+            LOGGER.warning(f"FloodWait of {e.value}s while downloading {message.id}")
+            await asyncio.sleep(e.value + 1)
+        except Exception as e:
+            LOGGER.error(f"Download of {message.id} failed ({attempt}): {e}")
+    return None
+
+
+# the loop only keeps weak references to tasks, hold the runners here
+_runners = set()
+
+
+def downloadParts(c: Client, messages: list, user_id: int, status: Message = None) -> list:
+    """
+    Start downloading `messages` in parallel.
+
+    Parameters:
+    - `messages`: Queued Telegram messages, in merge order.
+    - `user_id`: Owner of the queue.
+    - `status`: Editable Message for showing download progress.
+
+    returns: Futures resolving to the file paths (None on failure), in
+    the same order as `messages`. Cancelling a future skips its download.
+    """
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in messages]
+    total = sum(
+        (m.video or m.document or m.audio).file_size or 0 for m in messages
+    )
+    tracker = None
+    if status is not None:
+        tracker = BatchProgress(
+            Progress(user_id, c, status),
+            total,
+            len(messages),
+            "Downloading queued files",
+            "Downloaded",
+        )
+
+    async def one(limit: asyncio.Semaphore, message: Message, future: asyncio.Future):
+        async with limit:
+            if future.done():
+                return
+            path = await downloadMessage(
+                c, message, user_id, tracker.update if tracker else None
+            )
+        if tracker is not None:
+            tracker.finish()
+        if not future.done():
+            future.set_result(path)
+
+    async def runner():
+        try:
+            async with scheduler.slot("download", user_id, status):
+                limit = asyncio.Semaphore(Config.DOWNLOAD_CONCURRENCY)
+                await asyncio.gather(
+                    *(one(limit, m, f) for m, f in zip(messages, futures)),
+                    return_exceptions=True,
+                )
+        finally:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+    task = asyncio.ensure_future(runner())
+    _runners.add(task)
+    task.add_done_callback(_runnerDone)
+    return futures
+
+
+def _runnerDone(task: asyncio.Task):
+    _runners.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        LOGGER.error(f"Queue download failed: {task.exception()}")
+
+
+async def downloadQueue(c: Client, messages: list, user_id: int, status: Message = None) -> list:
+    """
+    Download `messages` in parallel and wait for all of them.
+
+    returns: file paths (None on failure), in the same order as `messages`
+    """
+    return list(await asyncio.gather(*downloadParts(c, messages, user_id, status)))
@@ -4,7 +4,7 @@ from pyrogram import Client
 from pyrogram.types import Message, InlineKeyboardMarkup
 
 from __init__ import LOGGER, queueDB, formatDB, replyDB
-from helpers.file_type_detector import MediaTypeDetector
+from helpers.file_type_detection import MediaTypeDetector
 from helpers.utils import UserSettings
 
 class EnhancedFileHandler:
@@ -26,17 +26,16 @@ class EnhancedFileHandler:
         merge_mode = user_settings.merge_mode
         
         # Detect file type
-        detected_type, detection_info = MediaTypeDetector.detect_media_type(message, file_path)
+        detected_type, detection_info = MediaTypeDetector.classify(message, file_path)
         
         if not detected_type:
             return False, "Could not determine file type. Please check the file and try again.", detection_info
         
         # Get file extension
-        media = message.video or message.document or message.audio
-        if not media or not media.file_name:
+        if not detection_info['filename']:
             return False, "File name not found.", detection_info
         
-        extension = MediaTypeDetector.get_file_extension(media.file_name)
+        extension = detection_info['extension']
         if not extension:
             return False, "Could not determine file extension.", detection_info
         
@@ -92,13 +91,9 @@ class EnhancedFileHandler:
         Returns:
             bool: True if config file was processed, False otherwise
         """
-        media = message.video or message.document or message.audio
-        if not media or not media.file_name:
-            return False
-        
-        extension = MediaTypeDetector.get_file_extension(media.file_name)
+        _, detection_info = MediaTypeDetector.classify(message)
         
-        if extension == 'conf':
+        if detection_info['extension'] == 'conf':
             from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
             
             await message.reply_text(
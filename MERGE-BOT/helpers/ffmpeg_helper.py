@@ -1,16 +1,505 @@
 import asyncio
-import subprocess
+import bisect
+import functools
+import math
+import re
 import shutil
 import os
+import threading
 import time
+from collections import OrderedDict, deque
 import ffmpeg
 from pyrogram.types import CallbackQuery
 from config import Config
 from pyrogram.types import Message
-from __init__ import LOGGER
+from __init__ import (
+    FINISHED_PROGRESS_STR,
+    LOGGER,
+    UN_FINISHED_PROGRESS_STR,
+)
+from helpers.display_progress import TimeFormatter, progressDispatcher
+from helpers.scheduler import scheduled
 from helpers.utils import get_path_size
 
+PROBE_CACHE_SIZE = 256
+# ffmpeg stderr lines kept for logging, older lines are dropped
+STDERR_TAIL_LINES = 50
+STDERR_READ_SIZE = 64 * 1024
+# target part size as a share of the limit, and how often to look for new parts
+SPLIT_HEADROOM = 0.9
+SPLIT_POLL_INTERVAL = 1
+SPLIT_MAX_DEPTH = 3
+KEYFRAME_CACHE_SIZE = 64
+# keyframes closer than this to a cut point count as on it
+TRIM_TOLERANCE = 0.05
+# encoder profile matching the source's, so re-encoded trim edges can be
+# joined to its stream copied middle
+TRIM_PROFILES = {
+    "h264": {
+        "Constrained Baseline": "baseline",
+        "Baseline": "baseline",
+        "Main": "main",
+        "High": "high",
+        "High 10": "high10",
+        "High 4:2:2": "high422",
+        "High 4:4:4 Predictive": "high444",
+    },
+    "hevc": {"Main": "main", "Main 10": "main10"},
+}
+_probe_cache: OrderedDict = OrderedDict()
+_keyframe_cache: OrderedDict = OrderedDict()
+_probe_lock = threading.Lock()
 
+# encoders used to bring a mismatched part in line with the first video
+VIDEO_ENCODERS = {
+    "h264": "libx264",
+    "hevc": "libx265",
+    "vp8": "libvpx",
+    "vp9": "libvpx-vp9",
+    "av1": "libaom-av1",
+    "mpeg4": "mpeg4",
+    "mpeg2video": "mpeg2video",
+}
+AUDIO_ENCODERS = {
+    "aac": "aac",
+    "mp3": "libmp3lame",
+    "opus": "libopus",
+    "vorbis": "libvorbis",
+    "ac3": "ac3",
+    "eac3": "eac3",
+    "flac": "flac",
+}
+
+
+# shared by every ffmpeg run so concurrent muxes can't oversubscribe the CPU
+_ffmpeg_slots = asyncio.Semaphore(Config.FFMPEG_CONCURRENCY)
+
+
+async def runCommand(cmd: list):
+    """
+    Run `cmd` without blocking the event loop, waiting for a free
+    ffmpeg slot first.
+
+    returns: (returncode, stdout, stderr)
+    """
+    async with _ffmpeg_slots:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+    return (
+        process.returncode,
+        stdout.decode(errors="replace").strip(),
+        stderr.decode(errors="replace").strip(),
+    )
+
+
+async def readLines(stream: asyncio.StreamReader):
+    """
+    Yield the non-empty lines of `stream` until EOF. Read in chunks, so
+    a line over the StreamReader limit can't raise, and split on carriage
+    returns too, ffmpeg's stats lines have no newline. A line longer than
+    STDERR_READ_SIZE keeps only its end.
+    """
+    pending = b""
+    while True:
+        chunk = await stream.read(STDERR_READ_SIZE)
+        if not chunk:
+            break
+        lines = re.split(rb"[\r\n]", pending + chunk)
+        # the last piece may be an unfinished line, bounded in size
+        pending = lines.pop()[-STDERR_READ_SIZE:]
+        for line in lines:
+            if line.strip():
+                yield line.decode(errors="replace").rstrip()
+    if pending.strip():
+        yield pending.decode(errors="replace").rstrip()
+
+
+async def _drainStderr(stream: asyncio.StreamReader, tail: deque):
+    """Keep the last lines of `stream` in `tail` until EOF"""
+    async for line in readLines(stream):
+        tail.append(line)
+
+
+def _ffmpegProgressText(ud_type: str, state: dict, duration: float, start: float, now: float):
+    try:
+        done = int(state.get("out_time_us") or state.get("out_time_ms") or 0) / 1000000
+    except ValueError:
+        done = 0
+    elapsed = max(now - start, 0.001)
+    text = f"{ud_type}\n\n**⌧ Processed ⏱ :** `〚{TimeFormatter(done * 1000) or '0s'}〛`"
+    if duration > 0:
+        percentage = min(done * 100 / duration, 100)
+        rate = done / elapsed
+        eta = (duration - done) / rate if rate > 0 else 0
+        text = (
+            "{0}\n<code>[{1}{2}] {3}%</code>\n"
+            "**⌧ Processed ⏱ :** `〚{4} / {5}〛`\n"
+            "**⌧ ETA 🔃 :** `〚{6}〛`"
+        ).format(
+            ud_type,
+            FINISHED_PROGRESS_STR * math.floor(percentage / 5),
+            UN_FINISHED_PROGRESS_STR * (20 - math.floor(percentage / 5)),
+            round(percentage, 2),
+            TimeFormatter(done * 1000) or "0s",
+            TimeFormatter(duration * 1000),
+            TimeFormatter(eta * 1000) or "0s",
+        )
+    speed = state.get("speed", "").strip()
+    if speed and speed != "N/A":
+        text += f"\n**⌧ Speed 📊 :** `〚{speed}〛`"
+    return text, None
+
+
+async def runCommandWithProgress(cmd: list, duration: float, message: Message, ud_type: str):
+    """
+    Run an ffmpeg `cmd` and keep `message` updated from its `-progress` output.
+
+    Parameters:
+    - `cmd`: ffmpeg command, `-progress` is added here.
+    - `duration`: Expected output duration in seconds, 0 if unknown.
+    - `message`: Editable Message for showing progress.
+    - `ud_type`: Title shown above the progress bar.
+
+    returns: (returncode, last stderr lines)
+    """
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    async with _ffmpeg_slots:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        drainer = asyncio.ensure_future(_drainStderr(process.stderr, tail))
+        start = time.time()
+        state = {}
+        async for raw in process.stdout:
+            key, _, value = raw.decode(errors="replace").strip().partition("=")
+            state[key] = value
+            # a progress=continue|end line closes each report block
+            if key != "progress":
+                continue
+            await progressDispatcher.submit(
+                message,
+                functools.partial(
+                    _ffmpegProgressText, ud_type, dict(state), duration, start, time.time()
+                ),
+                final=value == "end",
+            )
+        progressDispatcher.discard(message)
+        await process.wait()
+        await drainer
+    return process.returncode, "\n".join(tail)
+
+
+async def runCommandToPipe(cmd: list, fd: int):
+    """
+    Run an ffmpeg `cmd` writing to `pipe:1` with its stdout on `fd`.
+    The fd is always closed here, once ffmpeg has it or when cancelled
+    while waiting for a slot, so the reader sees EOF when ffmpeg exits.
+    Cancelling kills ffmpeg.
+
+    returns: (returncode, last stderr lines)
+    """
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    closed = False
+    try:
+        async with _ffmpeg_slots:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=fd,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            finally:
+                os.close(fd)
+                closed = True
+            drainer = asyncio.ensure_future(_drainStderr(process.stderr, tail))
+            try:
+                await process.wait()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                await drainer
+    finally:
+        if not closed:
+            os.close(fd)
+    return process.returncode, "\n".join(tail)
+
+
+def streamingMergeCommand(input_file: str, format_: str):
+    """
+    ffmpeg command concatenating the files listed in `input_file` to
+    stdout. A pipe can't be seeked back into, so mp4 is written as
+    fragmented mp4 and every other format as matroska.
+
+    returns: (command, output extension)
+    """
+    if format_.lower() in ("mp4", "m4v", "mov"):
+        muxer = ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov"]
+        ext = "mp4"
+    else:
+        muxer = ["-f", "matroska"]
+        ext = "mkv"
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        input_file,
+        "-map",
+        "0",
+        "-c",
+        "copy",
+        *muxer,
+        "pipe:1",
+    ]
+    return cmd, ext
+
+
+def probe(path: str) -> dict:
+    """
+    ffprobe `path`, reusing the previous result while the file's
+    size and mtime are unchanged.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _probe_lock:
+        data = _probe_cache.get(key)
+        if data is not None:
+            _probe_cache.move_to_end(key)
+            return data
+    data = ffmpeg.probe(filename=path)
+    with _probe_lock:
+        _probe_cache[key] = data
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return data
+
+
+async def probeAsync(path: str) -> dict:
+    return await asyncio.to_thread(probe, path)
+
+
+def _firstStream(data: dict, codec_type: str):
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") != codec_type:
+            continue
+        if stream.get("disposition", {}).get("attached_pic"):
+            continue
+        return stream
+    return None
+
+
+def _streams(data: dict) -> list:
+    return [
+        stream
+        for stream in data.get("streams", [])
+        if stream.get("codec_type") in ("video", "audio", "subtitle")
+        and not stream.get("disposition", {}).get("attached_pic")
+    ]
+
+
+def _videoKey(stream: dict):
+    return (
+        stream.get("codec_name"),
+        stream.get("width"),
+        stream.get("height"),
+        stream.get("pix_fmt"),
+        stream.get("r_frame_rate"),
+    )
+
+
+def _audioKey(stream: dict):
+    return (
+        stream.get("codec_name"),
+        stream.get("sample_rate"),
+        stream.get("channels"),
+    )
+
+
+def streamSignature(path: str) -> dict:
+    """
+    Return the properties that must match for a concat stream copy.
+    The video time base is not one of them, a copy remux fixes it.
+    """
+    streams = _streams(probe(path))
+    return {
+        "layout": tuple(stream["codec_type"] for stream in streams),
+        "video": tuple(_videoKey(s) for s in streams if s["codec_type"] == "video"),
+        "audio": tuple(_audioKey(s) for s in streams if s["codec_type"] == "audio"),
+        "subtitle": tuple(
+            s.get("codec_name") for s in streams if s["codec_type"] == "subtitle"
+        ),
+    }
+
+
+def _videoTimeBase(path: str):
+    video = _firstStream(probe(path), "video")
+    return None if video is None else video.get("time_base")
+
+
+def checkCompatibility(files: list) -> list:
+    """
+    Compare every video against the first one.
+
+    returns: indexes of the files that can not be stream copied as they are
+    """
+    if len(files) < 2:
+        return []
+    reference = streamSignature(files[0])
+    mismatched = [
+        i for i in range(1, len(files)) if streamSignature(files[i]) != reference
+    ]
+    if files[0].lower().endswith((".mp4", ".m4v", ".mov")):
+        # mp4 parts with another timescale only need a copy remux
+        time_base = _videoTimeBase(files[0])
+        mismatched += [
+            i
+            for i in range(1, len(files))
+            if i not in mismatched and _videoTimeBase(files[i]) != time_base
+        ]
+        mismatched.sort()
+    return mismatched
+
+
+def readConcatList(input_file: str) -> list:
+    files = []
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line in f:
+            match = re.match(r"^\s*file\s+'(.*)'\s*$", line)
+            if match:
+                files.append(match.group(1).replace("'\\''", "'"))
+    return files
+
+
+def writeConcatList(input_file: str, files: list):
+    with open(input_file, "w", encoding="utf-8") as f:
+        for path in files:
+            escaped = path.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+
+def _channelLayout(audio: dict) -> str:
+    layout = audio.get("channel_layout")
+    if layout:
+        return layout
+    return {1: "mono", 2: "stereo"}.get(audio.get("channels"), f"{audio.get('channels')}c")
+
+
+async def normalizePart(path: str, reference: str, output: str):
+    """
+    Rebuild `path` with the stream layout of `reference`, re-encoding only
+    the streams that differ from it. Audio tracks the part lacks are
+    filled with silence, and mp4 outputs get the reference's timescale.
+    A part missing a video or subtitle stream can't be normalized.
+
+    returns: `output` on success, None when the part can't be normalized
+    """
+    refData = await probeAsync(reference)
+    curData = await probeAsync(path)
+    ref_streams = _streams(refData)
+    cur_streams = {
+        codec_type: [s for s in _streams(curData) if s["codec_type"] == codec_type]
+        for codec_type in ("video", "audio", "subtitle")
+    }
+    try:
+        part_duration = float(curData["format"]["duration"])
+    except (KeyError, ValueError):
+        part_duration = 0
+    inputs = ["-i", path]
+    silences = 0
+    maps = []
+    codecs = []
+    counts = {"video": 0, "audio": 0, "subtitle": 0}
+    for ref in ref_streams:
+        codec_type = ref["codec_type"]
+        k = counts[codec_type]
+        counts[codec_type] += 1
+        have = cur_streams[codec_type]
+        spec = f"{codec_type[0]}:{k}"
+        if codec_type == "video":
+            if k >= len(have):
+                LOGGER.warning(f"{path} has no video stream {k}, can't normalize it")
+                return None
+            maps += ["-map", f"0:V:{k}"]
+            if _videoKey(have[k]) == _videoKey(ref):
+                codecs += [f"-c:{spec}", "copy"]
+                continue
+            codec, width, height, pix_fmt, frame_rate = _videoKey(ref)
+            encoder = VIDEO_ENCODERS.get(codec)
+            if encoder is None:
+                LOGGER.warning(f"No encoder known for {codec}, can't normalize {path}")
+                return None
+            codecs += [
+                f"-c:{spec}",
+                encoder,
+                f"-filter:{spec}",
+                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1",
+                f"-pix_fmt:{spec}",
+                pix_fmt,
+                f"-r:{spec}",
+                frame_rate,
+            ]
+            if encoder in ("libx264", "libx265"):
+                codecs += ["-preset", "veryfast", "-crf", "20"]
+        elif codec_type == "audio":
+            codec, sample_rate, channels = _audioKey(ref)
+            if k < len(have):
+                maps += ["-map", f"0:a:{k}"]
+                if _audioKey(have[k]) == _audioKey(ref):
+                    codecs += [f"-c:{spec}", "copy"]
+                    continue
+            else:
+                # no such track in this part, keep the layout with silence
+                inputs += [
+                    "-f",
+                    "lavfi",
+                    "-t",
+                    str(part_duration),
+                    "-i",
+                    f"anullsrc=r={sample_rate}:cl={_channelLayout(ref)}",
+                ]
+                silences += 1
+                maps += ["-map", f"{silences}:a:0"]
+            encoder = AUDIO_ENCODERS.get(codec)
+            if encoder is None:
+                LOGGER.warning(f"No encoder known for {codec}, can't normalize {path}")
+                return None
+            codecs += [f"-c:{spec}", encoder, f"-ar:{spec}", str(sample_rate), f"-ac:{spec}", str(channels)]
+        else:
+            if k >= len(have):
+                # concat needs the same streams in every part
+                LOGGER.warning(f"{path} has no subtitle stream {k}, can't normalize it")
+                return None
+            maps += ["-map", f"0:s:{k}"]
+            codecs += [f"-c:{spec}", "copy"]
+    cmd = ["ffmpeg", "-hide_banner", "-y", *inputs, *maps, *codecs]
+    time_base = _firstStream(refData, "video") or {}
+    time_base = time_base.get("time_base")
+    if output.lower().endswith((".mp4", ".m4v", ".mov")) and time_base:
+        cmd += ["-video_track_timescale", time_base.split("/")[-1]]
+    cmd.append(output)
+    LOGGER.info(cmd)
+    returncode, _, stderr = await runCommand(cmd)
+    if returncode != 0 or not os.path.exists(output):
+        LOGGER.error(stderr[-2000:])
+        return None
+    return output
+
+
+@scheduled("process")
 async def MergeVideo(input_file: str, user_id: int, message: Message, format_: str):
     """
     This is for Merging Videos Together!
@@ -21,6 +510,27 @@ async def MergeVideo(input_file: str, user_id: int, message: Message, format_: s
     :return: This will return Merged Video File Path
     """
     output_vid = f"downloads/{str(user_id)}/[@yashoswalyo].{format_.lower()}"
+    files = readConcatList(input_file)
+    mismatched = await asyncio.to_thread(checkCompatibility, files)
+    if mismatched:
+        await message.edit(
+            f"Merging Video Now ...\n\nRe-encoding {len(mismatched)} incompatible part(s) ..."
+        )
+        for i in mismatched:
+            ext = os.path.splitext(files[i])[1]
+            normalized = await normalizePart(
+                files[i],
+                files[0],
+                f"downloads/{str(user_id)}/normalized_{i}{ext}",
+            )
+            if normalized is None:
+                # concatenating it as it is would give a broken output
+                await message.edit(
+                    f"❌ Part {i + 1} can't be made compatible with the first video, merge stopped."
+                )
+                return None
+            files[i] = normalized
+        writeConcatList(input_file, files)
     file_generator_command = [
         "ffmpeg",
         "-f",
@@ -35,12 +545,16 @@ async def MergeVideo(input_file: str, user_id: int, message: Message, format_: s
         "copy",
         output_vid,
     ]
-    process = None
+    duration = 0.0
+    for path in files:
+        try:
+            duration += float((await probeAsync(path))["format"]["duration"])
+        except Exception as e:
+            LOGGER.warning(f"Could not read duration of {path}: {e}")
+    await message.edit("Merging Video Now ...\n\nPlease Keep Patience ...")
     try:
-        process = await asyncio.create_subprocess_exec(
-            *file_generator_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        returncode, e_response = await runCommandWithProgress(
+            file_generator_command, duration, message, "Merging Video Now ..."
         )
     except NotImplementedError:
         await message.edit(
@@ -48,18 +562,224 @@ async def MergeVideo(input_file: str, user_id: int, message: Message, format_: s
         )
         await asyncio.sleep(10)
         return None
-    await message.edit("Merging Video Now ...\n\nPlease Keep Patience ...")
-    stdout, stderr = await process.communicate()
-    e_response = stderr.decode().strip()
-    t_response = stdout.decode().strip()
     LOGGER.info(e_response)
-    LOGGER.info(t_response)
-    if os.path.lexists(output_vid):
+    if returncode == 0 and os.path.lexists(output_vid):
         return output_vid
     else:
         return None
 
 
+@scheduled("process")
+async def MergeVideoStreaming(parts: list, user_id: int, message: Message, format_: str):
+    """
+    This is for Merging Videos while they are still being downloaded.
+
+    Every part is remuxed to MPEG-TS with its timestamps shifted by the
+    duration of the parts before it, and the segments are fed in order into
+    one ffmpeg writing the final file, so merging overlaps with downloading.
+    Parts that don't match the first video are normalized first, as in
+    `MergeVideo`. An ffmpeg slot is only held while a part is being muxed,
+    not while waiting for its download.
+    MPEG-TS can't carry text subtitles, so when the first video has
+    subtitle streams all parts are awaited and merged by `MergeVideo`
+    instead, which keeps them.
+
+    :param `parts`: Awaitables resolving to downloaded part paths (or None to skip), in merge order.
+    :param `user_id`: Pass user_id as integer.
+    :param `message`: Pass Editable Message for Showing FFmpeg Progress.
+    :param `format_`: Pass File Extension.
+    :return: This will return Merged Video File Path
+    """
+    # start every download now, segments are still consumed in order
+    tasks = [asyncio.ensure_future(part) for part in parts]
+    try:
+        return await _mergeStreaming(tasks, user_id, message, format_)
+    except NotImplementedError:
+        await message.edit(
+            text="Unable to Execute FFmpeg Command! Got `NotImplementedError` ...\n\nPlease run bot in a Linux/Unix Environment."
+        )
+        await asyncio.sleep(10)
+        return None
+    finally:
+        # stop the downloads that are still running before returning
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _segmentSignature(path: str):
+    # segments carry the video and audio streams only
+    signature = streamSignature(path)
+    return signature["video"], signature["audio"]
+
+
+async def _feedSegment(merger, part_path: str, offset: float):
+    """
+    Remux `part_path` to MPEG-TS starting at `offset` into the merger's stdin.
+
+    returns: (returncode, last stderr lines) of the segmenter
+    """
+    segmenter = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        "-loglevel",
+        "error",
+        "-i",
+        part_path,
+        "-map",
+        "0:V",
+        "-map",
+        "0:a?",
+        "-c",
+        "copy",
+        "-muxdelay",
+        "0",
+        "-muxpreload",
+        "0",
+        "-output_ts_offset",
+        str(offset),
+        "-f",
+        "mpegts",
+        "pipe:1",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = asyncio.ensure_future(_drainStderr(segmenter.stderr, tail))
+    try:
+        while True:
+            chunk = await segmenter.stdout.read(1024 * 1024)
+            if not chunk:
+                break
+            merger.stdin.write(chunk)
+            await merger.stdin.drain()
+        await segmenter.wait()
+    finally:
+        if segmenter.returncode is None:
+            segmenter.kill()
+            await segmenter.wait()
+        await reader
+    return segmenter.returncode, "\n".join(tail)
+
+
+async def _mergeStreaming(tasks: list, user_id: int, message: Message, format_: str):
+    output_vid = f"downloads/{str(user_id)}/[@yashoswalyo].{format_.lower()}"
+    first = None
+    for n, task in enumerate(tasks, start=1):
+        await message.edit(
+            f"Merging Video Now ...\n\nWaiting for part {n}/{len(tasks)} ..."
+        )
+        first = await task
+        if first is not None:
+            break
+        LOGGER.warning(f"Part {n} of {user_id} missing, skipping it")
+    if first is None:
+        return None
+    if _firstStream(await probeAsync(first), "subtitle") is not None:
+        files = [path for path in [await task for task in tasks] if path is not None]
+        input_file = f"downloads/{str(user_id)}/input.txt"
+        writeConcatList(input_file, files)
+        return await MergeVideo.__wrapped__(input_file, user_id, message, format_)
+    reference = await asyncio.to_thread(_segmentSignature, first)
+    merger = None
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_reader = None
+    offset = 0.0
+    failed = False
+    try:
+        for n, task in enumerate(tasks, start=1):
+            await message.edit(
+                f"Merging Video Now ...\n\nWaiting for part {n}/{len(tasks)} ..."
+            )
+            part_path = await task
+            if part_path is None:
+                LOGGER.warning(f"Part {n} of {user_id} missing, skipping it")
+                continue
+            if (
+                part_path != first
+                and await asyncio.to_thread(_segmentSignature, part_path) != reference
+            ):
+                await message.edit(
+                    f"Merging Video Now ...\n\nRe-encoding incompatible part {n}/{len(tasks)} ..."
+                )
+                ext = os.path.splitext(part_path)[1]
+                normalized = await normalizePart(
+                    part_path, first, f"downloads/{str(user_id)}/normalized_{n}{ext}"
+                )
+                if normalized is None:
+                    await message.edit(
+                        f"❌ Part {n} can't be made compatible with the first video, merge stopped."
+                    )
+                    failed = True
+                    break
+                part_path = normalized
+            partData = await probeAsync(part_path)
+            duration = float(partData["format"]["duration"])
+            await message.edit(f"Merging Video Now ...\n\nMuxing part {n}/{len(tasks)} ...")
+            async with _ffmpeg_slots:
+                if merger is None:
+                    merger = await asyncio.create_subprocess_exec(
+                        "ffmpeg",
+                        "-hide_banner",
+                        "-nostats",
+                        "-loglevel",
+                        "error",
+                        "-y",
+                        "-f",
+                        "mpegts",
+                        "-i",
+                        "pipe:0",
+                        "-map",
+                        "0",
+                        "-c",
+                        "copy",
+                        output_vid,
+                        stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+                    stderr_reader = asyncio.ensure_future(
+                        _drainStderr(merger.stderr, tail)
+                    )
+                returncode, segment_log = await _feedSegment(merger, part_path, offset)
+            if returncode != 0:
+                # a gap in the output is worse than no output
+                LOGGER.error(f"Remuxing part {n} of {user_id} failed:\n{segment_log}")
+                failed = True
+                break
+            offset += duration
+        if merger is not None and not failed:
+            async with _ffmpeg_slots:
+                # the merger writes the rest of the file once its input ends
+                merger.stdin.close()
+                await merger.wait()
+    except (BrokenPipeError, ConnectionResetError) as e:
+        LOGGER.error(f"FFmpeg merger exited early: {e}")
+    except BaseException:
+        if merger is not None:
+            merger.kill()
+        raise
+    finally:
+        if merger is not None:
+            if failed:
+                merger.kill()
+            if not merger.stdin.is_closing():
+                merger.stdin.close()
+            await merger.wait()
+            await stderr_reader
+    if merger is None:
+        return None
+    LOGGER.info("\n".join(tail))
+    if failed and os.path.lexists(output_vid):
+        os.remove(output_vid)
+    if not failed and merger.returncode == 0 and os.path.lexists(output_vid):
+        return output_vid
+    else:
+        return None
+
+
+@scheduled("process")
 async def MergeSub(filePath: str, subPath: str, user_id):
     """
     This is for Merging Video + Subtitle Together.
@@ -69,7 +789,7 @@ async def MergeSub(filePath: str, subPath: str, user_id):
     - `subPath`: Path to subtitile file.
     - `user_id`: To get parent directory.
 
-    returns: Merged Video File Path
+    returns: Merged Video File Path, None if ffmpeg failed
     """
     LOGGER.info("Generating mux command")
     muxcmd = []
@@ -87,7 +807,7 @@ async def MergeSub(filePath: str, subPath: str, user_id):
     muxcmd.append("0:s:?")
     muxcmd.append("-map")
     muxcmd.append("1:s")
-    videoData = ffmpeg.probe(filename=filePath)
+    videoData = await probeAsync(filePath)
     videoStreamsData = videoData.get("streams")
     subTrack = 0
     for i in range(len(videoStreamsData)):
@@ -105,14 +825,18 @@ async def MergeSub(filePath: str, subPath: str, user_id):
     muxcmd.append("srt")
     muxcmd.append(f"./downloads/{str(user_id)}/[@yashoswalyo]_softmuxed_video.mkv")
     LOGGER.info("Muxing subtitles")
-    subprocess.call(muxcmd)
+    returncode, _, stderr = await runCommand(muxcmd)
+    if returncode != 0:
+        LOGGER.error(stderr[-2000:])
+        return None
     orgFilePath = shutil.move(
         f"downloads/{str(user_id)}/[@yashoswalyo]_softmuxed_video.mkv", filePath
     )
     return orgFilePath
 
 
-def MergeSubNew(filePath: str, subPath: str, user_id, file_list):
+@scheduled("process")
+async def MergeSubNew(filePath: str, subPath: str, user_id, file_list):
     """
     This method is for Merging Video + Subtitle(s) Together.
 
@@ -122,13 +846,13 @@ def MergeSubNew(filePath: str, subPath: str, user_id, file_list):
     - `user_id`: To get parent directory.
     - `file_list`: List of all input files
 
-    returns: Merged Video File Path
+    returns: Merged Video File Path, None if ffmpeg failed
     """
     LOGGER.info("Generating mux command")
     muxcmd = []
     muxcmd.append("ffmpeg")
     muxcmd.append("-hide_banner")
-    videoData = ffmpeg.probe(filename=filePath)
+    videoData = await probeAsync(filePath)
     videoStreamsData = videoData.get("streams")
     subTrack = 0
     for i in range(len(videoStreamsData)):
@@ -157,16 +881,30 @@ def MergeSubNew(filePath: str, subPath: str, user_id, file_list):
     muxcmd.append("srt")
     muxcmd.append(f"./downloads/{str(user_id)}/[@yashoswalyo]_softmuxed_video.mkv")
     LOGGER.info("Sub muxing")
-    subprocess.call(muxcmd)
+    returncode, _, stderr = await runCommand(muxcmd)
+    if returncode != 0:
+        LOGGER.error(stderr[-2000:])
+        return None
     return f"downloads/{str(user_id)}/[@yashoswalyo]_softmuxed_video.mkv"
 
 
-def MergeAudio(videoPath: str, files_list: list, user_id):
+@scheduled("process")
+async def MergeAudio(videoPath: str, files_list: list, user_id):
+    """
+    This method is for Merging Video + Audio(s) Together.
+
+    Parameters:
+    - `videoPath`: Path to Video file.
+    - `files_list`: List of all input files, the video first.
+    - `user_id`: To get parent directory.
+
+    returns: Merged Video File Path, None if ffmpeg failed
+    """
     LOGGER.info("Generating Mux Command")
     muxcmd = []
     muxcmd.append("ffmpeg")
     muxcmd.append("-hide_banner")
-    videoData = ffmpeg.probe(filename=videoPath)
+    videoData = await probeAsync(videoPath)
     videoStreamsData = videoData.get("streams")
     audioTracks = 0
     for i in files_list:
@@ -202,16 +940,350 @@ def MergeAudio(videoPath: str, files_list: list, user_id):
     muxcmd.append(f"downloads/{str(user_id)}/[@yashoswalyo]_export.mkv")
 
     LOGGER.info(muxcmd)
-    process = subprocess.call(muxcmd)
-    LOGGER.info(process)
+    returncode, _, stderr = await runCommand(muxcmd)
+    if returncode != 0:
+        LOGGER.error(stderr[-2000:])
+        return None
     return f"downloads/{str(user_id)}/[@yashoswalyo]_export.mkv"
 
 
+def _readSegmentList(list_path: str) -> list:
+    """returns: finished (name, start, end) rows of a csv segment list"""
+    try:
+        with open(list_path, "r", encoding="utf-8") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    rows = []
+    # the last line may still be being written
+    for line in data.split("\n")[:-1]:
+        name, start, end = line.rsplit(",", 2)
+        rows.append((name, float(start), float(end)))
+    return rows
+
+
+async def _segments(path: str, max_size: int, duration: float, depth: int = 0):
+    size = os.path.getsize(path)
+    if duration <= 0:
+        duration = float((await probeAsync(path))["format"]["duration"])
+    # cuts only land on keyframes and overshoot, so aim below the limit
+    segment_time = max(duration * max_size * SPLIT_HEADROOM / size, 1)
+    workdir = f"{path}.segments"
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    list_path = os.path.join(workdir, "list.csv")
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-i",
+        path,
+        "-map",
+        "0",
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_time",
+        f"{segment_time:.3f}",
+        "-reset_timestamps",
+        "1",
+        "-segment_list",
+        list_path,
+        "-segment_list_type",
+        "csv",
+        os.path.join(workdir, "%03d" + os.path.splitext(path)[1]),
+    ]
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    await _ffmpeg_slots.acquire()
+    released = False
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        drainer = asyncio.ensure_future(_drainStderr(process.stderr, tail))
+        waiter = asyncio.ensure_future(process.wait())
+        emitted = 0
+        while True:
+            await asyncio.wait({waiter}, timeout=SPLIT_POLL_INTERVAL)
+            if waiter.done() and not released:
+                # the cutting is over, don't hold the slot while uploading
+                _ffmpeg_slots.release()
+                released = True
+            rows = _readSegmentList(list_path)
+            for name, start, end in rows[emitted:]:
+                emitted += 1
+                part = os.path.join(workdir, name)
+                if (
+                    os.path.getsize(part) > max_size
+                    and depth < SPLIT_MAX_DEPTH
+                    and end - start > 1
+                ):
+                    LOGGER.info(f"{part} is still over the limit, splitting it again")
+                    # the nested split needs an ffmpeg slot, free ours first
+                    await asyncio.wait({waiter})
+                    if not released:
+                        _ffmpeg_slots.release()
+                        released = True
+                    async for sub in _segments(part, max_size, end - start, depth + 1):
+                        yield sub
+                    os.remove(part)
+                else:
+                    yield part, end - start
+            if waiter.done() and emitted >= len(rows):
+                break
+        await drainer
+        if process.returncode != 0:
+            LOGGER.error("\n".join(tail))
+            raise RuntimeError(f"Splitting {path} failed with {process.returncode}")
+    finally:
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+        if not released:
+            _ffmpeg_slots.release()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def splitVideo(path: str, max_size: int, duration: float = 0):
+    """
+    Cut `path` at keyframes into parts of at most `max_size` bytes, with
+    stream copy only.
+
+    This is an async generator. Parts are yielded in order as soon as ffmpeg
+    closes them, so the caller can upload part N while part N+1 is still
+    being cut. A part that still overshoots the limit is split again.
+    Delete each part once done with it.
+
+    Parameters:
+    - `path`: File to split.
+    - `max_size`: Largest allowed part size in bytes.
+    - `duration`: Duration of `path` in seconds, probed if 0.
+
+    yields: (part path, part duration), named `<name>.partNN.<ext>`
+    """
+    stem, ext = os.path.splitext(path)
+    n = 0
+    async for part, part_duration in _segments(path, max_size, duration):
+        n += 1
+        final = f"{stem}.part{n:02d}{ext}"
+        os.replace(part, final)
+        yield final, part_duration
+
+
+async def keyframeIndex(path: str) -> list:
+    """
+    Timestamps of the video keyframes of `path`, read from the packet
+    flags with ffprobe (no decoding). Cached while the file is unchanged.
+    Times count from the file's start_time, like input `-ss` does, TS
+    files often start well after zero.
+
+    returns: sorted keyframe times in seconds
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _probe_lock:
+        keyframes = _keyframe_cache.get(key)
+        if keyframes is not None:
+            _keyframe_cache.move_to_end(key)
+            return keyframes
+    returncode, stdout, stderr = await runCommand(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "V:0",
+            "-show_entries",
+            "packet=pts_time,flags",
+            "-of",
+            "csv=p=0",
+            path,
+        ]
+    )
+    if returncode != 0:
+        raise RuntimeError(f"ffprobe failed on {path}: {stderr[-500:]}")
+    try:
+        start_time = float((await probeAsync(path))["format"]["start_time"])
+    except (KeyError, ValueError):
+        start_time = 0.0
+    keyframes = []
+    for line in stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframes.append(float(pts_time) - start_time)
+    keyframes.sort()
+    with _probe_lock:
+        _keyframe_cache[key] = keyframes
+        while len(_keyframe_cache) > KEYFRAME_CACHE_SIZE:
+            _keyframe_cache.popitem(last=False)
+    return keyframes
+
+
+def _edgeEncoder(video: dict):
+    """
+    Encoder arguments reproducing the profile, level and reference count
+    of `video`, or None when its codec or profile can't be matched.
+    """
+    codec = video.get("codec_name")
+    profile = TRIM_PROFILES.get(codec, {}).get(video.get("profile"))
+    level = video.get("level")
+    if profile is None or not level or level < 0 or not video.get("pix_fmt"):
+        return None
+    encoder = VIDEO_ENCODERS[codec]
+    args = ["-c:v", encoder, "-pix_fmt", video["pix_fmt"], "-profile:v", profile]
+    args += ["-preset", "veryfast", "-crf", "18"]
+    if codec == "h264":
+        args += ["-level:v", f"{level / 10:.1f}"]
+        if video.get("refs"):
+            args += ["-refs", str(video["refs"])]
+    else:
+        args += ["-x265-params", f"level-idc={round(level / 30, 1)}:repeat-headers=1"]
+    return args
+
+
+async def _trimPiece(video_file: str, start: float, length: float, output: str, encoder: list = None):
+    """
+    Cut `length` seconds from `start` of every video and audio stream into
+    an MPEG-TS piece, stream copied unless `encoder` arguments are given.
+    MPEG-TS carries the parameter sets in-band, so pieces from different
+    encoders still join. It can't carry text subtitles, `_smartTrim` takes
+    those from the source when joining.
+    """
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-y",
+        "-ss",
+        f"{start:.6f}",
+        "-i",
+        video_file,
+        "-t",
+        f"{length:.6f}",
+        "-map",
+        "0:V",
+        "-map",
+        "0:a?",
+        "-c:a",
+        "copy",
+        *(encoder or ["-c:v", "copy"]),
+        "-avoid_negative_ts",
+        "make_zero",
+        "-muxdelay",
+        "0",
+        "-muxpreload",
+        "0",
+        "-f",
+        "mpegts",
+        output,
+    ]
+    returncode, _, stderr = await runCommand(cmd)
+    if returncode != 0 or not os.path.exists(output):
+        raise RuntimeError(f"Cutting {output} failed: {stderr[-500:]}")
+    return output
+
+
+async def _smartTrim(video_file: str, start: float, end: float, output: str):
+    """
+    Trim with stream copy between the first and last keyframe inside
+    [start, end], re-encoding only the partial GOPs at the two edges
+    with the source's profile and level.
+
+    returns: `output`, or None when the range holds no whole GOP or the
+    edges can't be encoded to match the source
+    """
+    video = _firstStream(await probeAsync(video_file), "video")
+    if video is None:
+        return None
+    encoder = _edgeEncoder(video)
+    if encoder is None:
+        return None
+    keyframes = await keyframeIndex(video_file)
+    first = bisect.bisect_left(keyframes, start - TRIM_TOLERANCE)
+    last = bisect.bisect_right(keyframes, end + TRIM_TOLERANCE) - 1
+    if first >= len(keyframes) or last < first or keyframes[last] <= keyframes[first]:
+        return None
+    body_start, body_end = keyframes[first], keyframes[last]
+    workdir = f"{output}.pieces"
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        jobs = []
+        edges = []
+        if body_start - start > TRIM_TOLERANCE:
+            edges.append(os.path.join(workdir, "0.ts"))
+            jobs.append(_trimPiece(video_file, start, body_start - start, edges[-1], encoder))
+        jobs.append(
+            _trimPiece(video_file, body_start, body_end - body_start, os.path.join(workdir, "1.ts"))
+        )
+        if end - body_end > TRIM_TOLERANCE:
+            edges.append(os.path.join(workdir, "2.ts"))
+            jobs.append(_trimPiece(video_file, body_end, end - body_end, edges[-1], encoder))
+        pieces = await asyncio.gather(*jobs)
+        for edge in edges:
+            encoded = _firstStream(await probeAsync(edge), "video") or {}
+            if any(
+                encoded.get(field) != video.get(field)
+                for field in ("codec_name", "profile", "width", "height", "pix_fmt")
+            ):
+                LOGGER.info(f"Trim edge {edge} doesn't match {video_file}, re-encoding all")
+                return None
+        concat_list = os.path.join(workdir, "list.txt")
+        writeConcatList(concat_list, [os.path.abspath(p) for p in pieces])
+        tag = []
+        if output.lower().endswith((".mp4", ".m4v", ".mov")):
+            # sample entries that allow the in-band parameter set changes
+            tag = ["-tag:v", "avc3" if video["codec_name"] == "h264" else "hev1"]
+            # the only text subtitles mp4 holds, as the re-encode fallback does
+            tag += ["-c:s", "mov_text"]
+        returncode, _, stderr = await runCommand(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-y",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                concat_list,
+                "-ss",
+                f"{start:.6f}",
+                "-t",
+                f"{end - start:.6f}",
+                "-i",
+                video_file,
+                "-map",
+                "0",
+                "-map",
+                "1:s?",
+                "-c",
+                "copy",
+                *tag,
+                output,
+            ]
+        )
+        if returncode != 0:
+            raise RuntimeError(f"Joining trimmed pieces failed: {stderr[-500:]}")
+        return output
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
 async def cult_small_video(video_file, output_directory, start_time, end_time, format_):
     # https://stackoverflow.com/a/13891070/4723940
     out_put_file_name = (
         output_directory + str(round(time.time())) + "." + format_.lower()
     )
+    try:
+        if await _smartTrim(
+            video_file, float(start_time), float(end_time), out_put_file_name
+        ):
+            return out_put_file_name
+    except Exception as e:
+        LOGGER.info(f"Keyframe trim of {video_file} failed, re-encoding: {e}")
     file_generator_command = [
         "ffmpeg",
         "-ss",
@@ -226,17 +1298,10 @@ async def cult_small_video(video_file, output_directory, start_time, end_time, f
         "-2",
         out_put_file_name,
     ]
-    process = await asyncio.create_subprocess_exec(
-        *file_generator_command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, stderr = await process.communicate()
-    e_response = stderr.decode().strip()
-    t_response = stdout.decode().strip()
+    returncode, t_response, e_response = await runCommand(file_generator_command)
     LOGGER.info(e_response)
     LOGGER.info(t_response)
-    if os.path.lexists(out_put_file_name):
+    if returncode == 0 and os.path.lexists(out_put_file_name):
         return out_put_file_name
     else:
         return None
@@ -284,16 +1349,10 @@ async def take_screen_shot(video_file, output_directory, ttl):
             out_put_file_name,
         ]
         # width = "90"
-        process = await asyncio.create_subprocess_exec(
-            *file_genertor_command,
-            # stdout must a pipe to be accessible as process.stdout
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        # Wait for the subprocess to finish
-        stdout, stderr = await process.communicate()
-        e_response = stderr.decode().strip()
-        t_response = stdout.decode().strip()
+        returncode, t_response, e_response = await runCommand(file_genertor_command)
+        if returncode != 0:
+            LOGGER.info(e_response)
+            return None
     #
     if os.path.exists(out_put_file_name):
         return out_put_file_name
@@ -301,127 +1360,183 @@ async def take_screen_shot(video_file, output_directory, ttl):
         return None
 
 
-async def extractAudios(path_to_file, user_id):
-    """
-    docs
-    """
-    dir_name = os.path.dirname(os.path.dirname(path_to_file))
-    if not os.path.exists(path_to_file):
-        return None
-    if not os.path.exists(dir_name + "/extract"):
-        os.makedirs(dir_name + "/extract")
-    videoStreamsData = ffmpeg.probe(path_to_file)
-    # with open("data.json",'w') as f:
-    #     f.write(json.dumps(videoStreamsData))
-    extract_dir = dir_name + "/extract"
-    audios = []
-    for stream in videoStreamsData.get("streams"):
+def _audioOutputName(audio: dict) -> str:
+    try:
+        output_file: str = (
+            "("
+            + audio["tags"]["language"]
+            + ") "
+            + audio["tags"]["title"]
+            + "."
+            + audio["codec_type"]
+            + ".mka"
+        )
+        output_file = output_file.replace(" ", ".")
+    except:
+        output_file = str(audio["index"]) + "." + audio["codec_type"] + ".mka"
+    return output_file
+
+
+def _subtitleOutputName(subtitle: dict) -> str:
+    try:
+        output_file: str = (
+            "("
+            + subtitle["tags"]["language"]
+            + ") "
+            + subtitle["tags"]["title"]
+            + "."
+            + subtitle["codec_type"]
+            + ".mka"
+        )
+        output_file = output_file.replace(" ", ".")
+    except:
         try:
+            output_file = (
+                str(subtitle["index"])
+                + "."
+                + subtitle["tags"]["language"]
+                + "."
+                + subtitle["codec_type"]
+                + ".mka"
+            )
+        except:
+            output_file = (
+                str(subtitle["index"]) + "." + subtitle["codec_type"] + ".mka"
+            )
+    return output_file
+
+
+def _extractOutputs(data: dict, codec_types: tuple) -> list:
+    """returns: (stream index, output file name) of every stream of `codec_types`"""
+    outputs = []
+    used_names = set()
+    for stream in data.get("streams"):
+        try:
+            if stream["codec_type"] not in codec_types:
+                continue
             if stream["codec_type"] == "audio":
-                audios.append(stream)
+                output_file = _audioOutputName(stream)
+            else:
+                output_file = _subtitleOutputName(stream)
+            if output_file in used_names:
+                # two tracks with the same language/title would overwrite each other
+                output_file = f"{stream['index']}.{output_file}"
+            used_names.add(output_file)
+            outputs.append((stream["index"], output_file))
         except Exception as e:
             LOGGER.warning(e)
-    for audio in audios:
-        extractcmd = []
-        extractcmd.append("ffmpeg")
-        extractcmd.append("-hide_banner")
-        extractcmd.append("-i")
-        extractcmd.append(path_to_file)
-        extractcmd.append("-map")
-        try:
-            index = audio["index"]
-            extractcmd.append(f"0:{index}")
-            try:
-                output_file: str = (
-                    "("
-                    + audio["tags"]["language"]
-                    + ") "
-                    + audio["tags"]["title"]
-                    + "."
-                    + audio["codec_type"]
-                    + ".mka"
-                )
-                output_file = output_file.replace(" ", ".")
-            except:
-                output_file = str(audio["index"]) + "." + audio["codec_type"] + ".mka"
-            extractcmd.append("-c")
-            extractcmd.append("copy")
-            extractcmd.append(f"{extract_dir}/{output_file}")
-            LOGGER.info(extractcmd)
-            subprocess.call(extractcmd)
-        except Exception as e:
-            LOGGER.error(f"Something went wrong: {e}")
-    if get_path_size(extract_dir) > 0:
-        return extract_dir
-    else:
-        LOGGER.warning(f"{extract_dir} is empty")
-        return None
+    return outputs
 
 
-async def extractSubtitles(path_to_file, user_id):
+async def streamingExtractCommands(path_to_file, codec_types: tuple) -> list:
+    """
+    ffmpeg commands copying every stream of `codec_types` out of
+    `path_to_file` to stdout, one per stream, as matroska like the files
+    `_extractStreams` writes.
+
+    returns: [(command, output file name), ...]
+    """
+    return [
+        (
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-i",
+                path_to_file,
+                "-map",
+                f"0:{index}",
+                "-c",
+                "copy",
+                "-f",
+                "matroska",
+                "pipe:1",
+            ],
+            output_file,
+        )
+        for index, output_file in _extractOutputs(await probeAsync(path_to_file), codec_types)
+    ]
+
+
+async def _extractStreams(path_to_file, codec_types: tuple):
     """
-    docs
+    Copy every stream of `codec_types` out of `path_to_file` into its own
+    file, demuxing the input only once.
+
+    returns: extract directory, or None when nothing was extracted
     """
     dir_name = os.path.dirname(os.path.dirname(path_to_file))
     if not os.path.exists(path_to_file):
         return None
     if not os.path.exists(dir_name + "/extract"):
         os.makedirs(dir_name + "/extract")
-    videoStreamsData = ffmpeg.probe(path_to_file)
-    # with open("data.json",'w') as f:
-    #     f.write(json.dumps(videoStreamsData))
+    videoStreamsData = await probeAsync(path_to_file)
     extract_dir = dir_name + "/extract"
-    subtitles = []
-    for stream in videoStreamsData.get("streams"):
-        try:
-            if stream["codec_type"] == "subtitle":
-                subtitles.append(stream)
-        except Exception as e:
-            LOGGER.warning(e)
-    for subtitle in subtitles:
-        extractcmd = []
-        extractcmd.append("ffmpeg")
-        extractcmd.append("-hide_banner")
-        extractcmd.append("-i")
-        extractcmd.append(path_to_file)
-        extractcmd.append("-map")
-        try:
-            index = subtitle["index"]
-            extractcmd.append(f"0:{index}")
+    outputs = [
+        (index, f"{extract_dir}/{output_file}")
+        for index, output_file in _extractOutputs(videoStreamsData, codec_types)
+    ]
+    if not outputs:
+        LOGGER.warning(f"No {'/'.join(codec_types)} streams in {path_to_file}")
+        return None
+    extractcmd = ["ffmpeg", "-hide_banner", "-y", "-i", path_to_file]
+    for index, output in outputs:
+        extractcmd += ["-map", f"0:{index}", "-c", "copy", output]
+    LOGGER.info(extractcmd)
+    returncode, _, stderr = await runCommand(extractcmd)
+    if returncode != 0:
+        # one bad track fails the whole pass, retry them one by one
+        LOGGER.warning(f"Single pass extraction failed, retrying per stream: {stderr[-1000:]}")
+        for index, output in outputs:
             try:
-                output_file: str = (
-                    "("
-                    + subtitle["tags"]["language"]
-                    + ") "
-                    + subtitle["tags"]["title"]
-                    + "."
-                    + subtitle["codec_type"]
-                    + ".mka"
+                await runCommand(
+                    [
+                        "ffmpeg",
+                        "-hide_banner",
+                        "-y",
+                        "-i",
+                        path_to_file,
+                        "-map",
+                        f"0:{index}",
+                        "-c",
+                        "copy",
+                        output,
+                    ]
                 )
-                output_file = output_file.replace(" ", ".")
-            except:
-                try:
-                    output_file = (
-                        str(subtitle["index"])
-                        + "."
-                        + subtitle["tags"]["language"]
-                        + "."
-                        + subtitle["codec_type"]
-                        + ".mka"
-                    )
-                except:
-                    output_file = (
-                        str(subtitle["index"]) + "." + subtitle["codec_type"] + ".mka"
-                    )
-            extractcmd.append("-c")
-            extractcmd.append("copy")
-            extractcmd.append(f"{extract_dir}/{output_file}")
-            LOGGER.info(extractcmd)
-            subprocess.call(extractcmd)
-        except Exception as e:
-            LOGGER.error(f"Something went wrong: {e}")
+            except Exception as e:
+                LOGGER.error(f"Something went wrong: {e}")
     if get_path_size(extract_dir) > 0:
         return extract_dir
     else:
         LOGGER.warning(f"{extract_dir} is empty")
         return None
+
+
+@scheduled("process")
+async def extractAudios(path_to_file, user_id):
+    """
+    Extract every audio track of `path_to_file` in a single ffmpeg pass.
+
+    returns: extract directory path
+    """
+    return await _extractStreams(path_to_file, ("audio",))
+
+
+@scheduled("process")
+async def extractSubtitles(path_to_file, user_id):
+    """
+    Extract every subtitle track of `path_to_file` in a single ffmpeg pass.
+
+    returns: extract directory path
+    """
+    return await _extractStreams(path_to_file, ("subtitle",))
+
+
+@scheduled("process")
+async def extractAll(path_to_file, user_id):
+    """
+    Extract every audio and subtitle track of `path_to_file` in a single
+    ffmpeg pass.
+
+    returns: extract directory path
+    """
+    return await _extractStreams(path_to_file, ("audio", "subtitle"))
@@ -1,5 +1,6 @@
 import os
 import mimetypes
+from collections import OrderedDict
 from typing import Tuple, Optional, Dict, List
 from pyrogram.types import Message, Document, Video, Audio
 
@@ -11,6 +12,63 @@ except ImportError:
 
 from __init__ import LOGGER
 
+# Media types a container signature may hold, by sniffed MIME type
+CONTAINER_TYPES = {
+    'video/x-matroska': ('video', 'audio', 'subtitle'),
+    'video/webm': ('video', 'audio'),
+    'video/mp4': ('video', 'audio'),
+    'audio/mp4': ('audio',),
+    'video/quicktime': ('video', 'audio'),
+    'video/x-msvideo': ('video',),
+    'audio/wav': ('audio',),
+    'video/ogg': ('video', 'audio'),
+    'audio/ogg': ('audio',),
+    'audio/mpeg': ('audio',),
+    'audio/aac': ('audio',),
+    'audio/flac': ('audio',),
+    'video/mp2t': ('video', 'audio'),
+    'video/x-flv': ('video', 'audio'),
+    'video/x-ms-asf': ('video', 'audio'),
+    'video/mpeg': ('video',),
+    'text/vtt': ('subtitle',),
+    'text/x-ssa': ('subtitle',),
+}
+# magic results that can never be a renamed media file
+NON_MEDIA_MIME_PREFIXES = (
+    'text/', 'image/', 'application/pdf', 'application/zip', 'application/gzip',
+    'application/x-rar', 'application/x-7z', 'application/x-tar',
+    'application/x-dosexec', 'application/x-executable', 'application/x-bittorrent',
+    'application/vnd.android', 'application/x-msdownload', 'application/msword',
+)
+# common non-media files, recognized even without python-magic
+NON_MEDIA_SIGNATURES = (
+    (b'PK\x03\x04', 'application/zip'),
+    (b'Rar!\x1a\x07', 'application/x-rar'),
+    (b"7z\xbc\xaf\x27\x1c", 'application/x-7z-compressed'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'MZ', 'application/x-dosexec'),
+    (b'\x7fELF', 'application/x-executable'),
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG', 'image/png'),
+)
+TS_PACKET_SIZE = 188
+# extensions whose real content sniff_container can tell apart from
+# another format, only these are worth fetching a header for
+SNIFFED_EXTENSIONS = frozenset((
+    'mp4', 'm4v', 'mov', '3gp', 'm4a', 'mkv', 'mka', 'mks', 'webm', 'avi',
+    'wav', 'ogg', 'ogv', 'opus', 'flac', 'flv', 'wmv', 'wma', 'asf', 'mpg',
+    'mpeg', 'vob', 'ts', 'mts', 'm2ts', 'mp3', 'aac', 'srt', 'vtt', 'ass', 'ssa',
+))
+# ftyp brands of still images stored in ISO media files
+IMAGE_BRANDS = {
+    b'heic': 'image/heic', b'heix': 'image/heic', b'heim': 'image/heic',
+    b'heis': 'image/heic', b'hevc': 'image/heic', b'mif1': 'image/heif',
+    b'msf1': 'image/heif', b'avif': 'image/avif', b'avis': 'image/avif',
+}
+# classifications remembered per file_unique_id, kind and file name
+CLASSIFY_CACHE_SIZE = 4096
+
+
 class MediaTypeDetector:
     """Enhanced media type detection with multiple validation methods"""
     
@@ -54,6 +112,64 @@ class MediaTypeDetector:
         }
     }
 
+    # Lookup tables compiled from MEDIA_TYPES by `compile_tables`
+    _extension_table: Dict[str, str] = {}
+    _mime_trie: Dict = {}
+    _classified: OrderedDict = OrderedDict()
+
+    @classmethod
+    def compile_tables(cls):
+        """
+        Build the extension -> type dict and the MIME prefix trie from
+        MEDIA_TYPES, so lookups no longer scan its lists. The trie's first
+        level is the major type ('video', 'text', ...), below it one node
+        per subtype character. Where entries overlap, the type listed
+        first in MEDIA_TYPES wins, as before
+        """
+        extension_table = {}
+        mime_trie = {}
+        for rank, (media_type, info) in enumerate(cls.MEDIA_TYPES.items()):
+            for extension in info['extensions']:
+                extension_table.setdefault(extension, media_type)
+            for pattern in info['mime_patterns']:
+                major, _, subtype = pattern.lower().partition('/')
+                node = mime_trie.setdefault(major, {})
+                for char in subtype:
+                    node = node.setdefault(char, {})
+                # None marks the end of a pattern: (rank, media_type)
+                if None not in node or node[None][0] > rank:
+                    node[None] = (rank, media_type)
+        cls._extension_table = extension_table
+        cls._mime_trie = mime_trie
+        cls._classified.clear()
+
+    @classmethod
+    def classify(cls, message: Message, file_path: Optional[str] = None) -> Tuple[Optional[str], Dict]:
+        """
+        The single entry point for classifying an incoming file.
+        Metadata-only results are memoized per file_unique_id, message
+        kind and file name (the result depends on all three), so a file
+        that is forwarded again, retried or re-validated is not
+        classified twice
+
+        Returns:
+            Tuple of (detected_type, detection_info)
+        """
+        telegram_type, media = cls.get_telegram_media_info(message)
+        unique_id = getattr(media, 'file_unique_id', None)
+        if file_path is not None or unique_id is None:
+            return cls.detect_media_type(message, file_path)
+        key = (unique_id, telegram_type, getattr(media, 'file_name', None))
+        cached = cls._classified.get(key)
+        if cached is not None:
+            cls._classified.move_to_end(key)
+            return cached[0], dict(cached[1])
+        detected_type, detection_info = cls.detect_media_type(message)
+        cls._classified[key] = (detected_type, detection_info)
+        if len(cls._classified) > CLASSIFY_CACHE_SIZE:
+            cls._classified.popitem(last=False)
+        return detected_type, dict(detection_info)
+
     @classmethod
     def get_file_extension(cls, filename: str) -> Optional[str]:
         """Extract file extension from filename"""
@@ -100,20 +216,142 @@ class MediaTypeDetector:
             LOGGER.warning(f"Magic detection failed for {file_path}: {e}")
             return None
 
+    @classmethod
+    def sniff_container(cls, header: bytes) -> Optional[str]:
+        """Identify the container from the signature at the start of a file"""
+        if not header:
+            return None
+        if header.startswith(b'\x1a\x45\xdf\xa3'):
+            return 'video/webm' if b'webm' in header[:64] else 'video/x-matroska'
+        if header[4:8] == b'ftyp':
+            brand = header[8:12]
+            if brand in IMAGE_BRANDS:
+                return IMAGE_BRANDS[brand]
+            if brand in (b'M4A ', b'M4B ', b'M4P '):
+                return 'audio/mp4'
+            return 'video/quicktime' if brand == b'qt  ' else 'video/mp4'
+        if header[4:8] in (b'moov', b'mdat', b'wide', b'free'):
+            return 'video/quicktime'
+        if header.startswith(b'RIFF'):
+            if header[8:12] == b'AVI ':
+                return 'video/x-msvideo'
+            if header[8:12] == b'WAVE':
+                return 'audio/wav'
+        if header.startswith(b'OggS'):
+            return 'video/ogg' if b'theora' in header[:512] else 'audio/ogg'
+        if header.startswith(b'fLaC'):
+            return 'audio/flac'
+        if header.startswith(b'FLV'):
+            return 'video/x-flv'
+        if header.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+            return 'video/x-ms-asf'
+        if header.startswith(b'\x00\x00\x01\xba'):
+            return 'video/mpeg'
+        # MPEG-TS, or M2TS with its 4 byte timestamp before each packet
+        for start, step in ((0, TS_PACKET_SIZE), (4, TS_PACKET_SIZE + 4)):
+            if len(header) >= start + 2 * step + 1 and all(
+                header[start + n * step] == 0x47 for n in range(3)
+            ):
+                return 'video/mp2t'
+        if header.startswith(b'ID3'):
+            return 'audio/mpeg'
+        if header.startswith(b'\xff\xd8\xff'):
+            return 'image/jpeg'
+        if len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+            # ADTS frames have a zero layer field, MPEG audio never does
+            return 'audio/aac' if header[1] & 0x06 == 0 else 'audio/mpeg'
+        for signature, mime_type in NON_MEDIA_SIGNATURES:
+            if header.startswith(signature):
+                return mime_type
+        text = header[:64].lstrip(b'\xef\xbb\xbf')
+        if text.startswith(b'WEBVTT'):
+            return 'text/vtt'
+        if text.startswith(b'[Script Info]'):
+            return 'text/x-ssa'
+        return None
+
+    @classmethod
+    def detect_file_type_by_buffer(cls, header: bytes) -> Optional[str]:
+        """Detect file type from the first bytes of a file"""
+        mime_type = cls.sniff_container(header)
+        if mime_type or not HAS_MAGIC:
+            return mime_type
+        try:
+            mime_type = magic.from_buffer(header, mime=True)
+            return mime_type.lower() if mime_type else None
+        except Exception as e:
+            LOGGER.warning(f"Magic detection failed on header: {e}")
+            return None
+
+    @classmethod
+    async def fetch_header(cls, client, message: Message) -> Optional[bytes]:
+        """
+        Download only the first chunk (1 MiB, pyrogram's streaming unit) of
+        a Telegram file
+
+        Returns:
+            The header bytes, or None if it could not be fetched
+        """
+        try:
+            async for chunk in client.stream_media(message, limit=1):
+                return bytes(chunk)
+        except Exception as e:
+            LOGGER.warning(f"Header fetch failed for message {message.id}: {e}")
+        return None
+
+    @classmethod
+    async def check_header(cls, client, message: Message) -> Tuple[bool, str]:
+        """
+        Compare the file's real content with its extension before the full
+        download, using only the first chunk of the file
+
+        Returns:
+            Tuple of (is_consistent, reason)
+        """
+        extension = cls.classify(message)[1]['extension']
+        claimed = cls.classify_by_extension(extension)
+        if claimed not in ('video', 'audio', 'subtitle') or extension not in SNIFFED_EXTENSIONS:
+            return True, "Nothing to verify"
+        header = await cls.fetch_header(client, message)
+        if header is None:
+            return True, "Header unavailable"
+        container = cls.sniff_container(header)
+        if container in CONTAINER_TYPES:
+            if claimed in CONTAINER_TYPES[container]:
+                return True, "Header matches extension"
+            return False, f"File named .{extension} is actually {container}"
+        if container is not None and container.startswith(NON_MEDIA_MIME_PREFIXES):
+            return False, f"File named .{extension} is actually {container}"
+        if claimed == 'subtitle':
+            # plain text subtitles have no reliable signature, and magic
+            # calls them text/plain
+            return True, "Header not recognized"
+        mime_magic = container or cls.detect_file_type_by_buffer(header)
+        if mime_magic and mime_magic.startswith(NON_MEDIA_MIME_PREFIXES):
+            return False, f"File named .{extension} is actually {mime_magic}"
+        return True, "Header not recognized"
+
     @classmethod
     def classify_by_mime_type(cls, mime_type: str) -> Optional[str]:
         """Classify media type based on MIME type"""
         if not mime_type:
             return None
         
-        mime_type = mime_type.lower()
-        
-        for media_type, info in cls.MEDIA_TYPES.items():
-            for pattern in info['mime_patterns']:
-                if mime_type.startswith(pattern.lower()):
-                    return media_type
+        # the earliest-listed type among all patterns prefixing mime_type
+        major, slash, subtype = mime_type.lower().partition('/')
+        node = cls._mime_trie.get(major)
+        if node is None or not slash:
+            return 'unknown'
+        best = node.get(None)
+        for char in subtype:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None)
+            if match is not None and (best is None or match[0] < best[0]):
+                best = match
         
-        return 'unknown'
+        return best[1] if best else 'unknown'
 
     @classmethod
     def classify_by_extension(cls, extension: str) -> Optional[str]:
@@ -121,18 +359,14 @@ class MediaTypeDetector:
         if not extension:
             return None
         
-        extension = extension.lower().strip()
-        
-        for media_type, info in cls.MEDIA_TYPES.items():
-            if extension in info['extensions']:
-                return media_type
-        
-        return 'unknown'
+        return cls._extension_table.get(extension.lower().strip(), 'unknown')
 
     @classmethod
-    def detect_media_type(cls, message: Message, file_path: Optional[str] = None) -> Tuple[Optional[str], Dict]:
+    def detect_media_type(cls, message: Message, file_path: Optional[str] = None, header: Optional[bytes] = None) -> Tuple[Optional[str], Dict]:
         """
-        Comprehensive media type detection using multiple methods
+        Comprehensive media type detection using multiple methods.
+        `header` is the start of the file, from `fetch_header`, when no
+        local copy exists yet
         
         Returns:
             Tuple of (detected_type, detection_info)
@@ -177,6 +411,9 @@ class MediaTypeDetector:
         if file_path:
             mime_magic = cls.detect_file_type_by_magic(file_path)
             detection_info['mime_type_magic'] = mime_magic
+        elif header:
+            mime_magic = cls.detect_file_type_by_buffer(header)
+            detection_info['mime_type_magic'] = mime_magic
         else:
             mime_magic = None
         
@@ -299,4 +536,67 @@ class MediaTypeDetector:
 # Convenience function for backward compatibility
 def detect_file_type(message: Message, file_path: Optional[str] = None) -> Tuple[Optional[str], Dict]:
     """Convenience function for file type detection"""
-    return MediaTypeDetector.detect_media_type(message, file_path)
\ No newline at end of file
+    return MediaTypeDetector.detect_media_type(message, file_path)
+
+
+MediaTypeDetector.compile_tables()
+
+
+if __name__ == '__main__':
+    # Microbenchmark: python -m helpers.file_type_detection
+    import timeit
+    from types import SimpleNamespace
+
+    def linear_extension(extension):
+        for media_type, info in MediaTypeDetector.MEDIA_TYPES.items():
+            if extension in info['extensions']:
+                return media_type
+        return 'unknown'
+
+    def linear_mime(mime_type):
+        for media_type, info in MediaTypeDetector.MEDIA_TYPES.items():
+            for pattern in info['mime_patterns']:
+                if mime_type.startswith(pattern):
+                    return media_type
+        return 'unknown'
+
+    samples = [
+        ('movie.mkv', 'video/x-matroska'), ('song.flac', 'audio/flac'),
+        ('subs.srt', 'application/x-subrip'), ('rclone.conf', 'text/plain'),
+        ('notes.txt', 'text/plain'), ('clip.dat', 'application/octet-stream'),
+        ('track.aiff', 'audio/x-aiff'), ('archive.zip', 'application/zip'),
+    ]
+    messages = [
+        SimpleNamespace(
+            id=n, video=None, audio=None,
+            document=SimpleNamespace(file_name=name, mime_type=mime, file_unique_id=f'u{n}'),
+        )
+        for n, (name, mime) in enumerate(samples)
+    ]
+    for name, mime in samples:
+        extension = MediaTypeDetector.get_file_extension(name)
+        assert MediaTypeDetector.classify_by_extension(extension) == linear_extension(extension)
+        assert MediaTypeDetector.classify_by_mime_type(mime) == linear_mime(mime)
+
+    runs = 20000
+
+    def per_call(statement):
+        return min(timeit.repeat(statement, number=runs, repeat=5)) / runs / len(samples) * 1e6
+
+    def cold():
+        MediaTypeDetector._classified.clear()
+        for m in messages:
+            MediaTypeDetector.classify(m)
+
+    LOGGER.disabled = True
+    results = [
+        ('extension, linear scan', per_call(lambda: [linear_extension(MediaTypeDetector.get_file_extension(n)) for n, _ in samples])),
+        ('extension, dict', per_call(lambda: [MediaTypeDetector.classify_by_extension(MediaTypeDetector.get_file_extension(n)) for n, _ in samples])),
+        ('mime, linear scan', per_call(lambda: [linear_mime(m) for _, m in samples])),
+        ('mime, trie', per_call(lambda: [MediaTypeDetector.classify_by_mime_type(m) for _, m in samples])),
+        ('message, detect_media_type', per_call(lambda: [MediaTypeDetector.detect_media_type(m) for m in messages])),
+        ('message, classify (cold)', per_call(cold)),
+        ('message, classify (memoized)', per_call(lambda: [MediaTypeDetector.classify(m) for m in messages])),
+    ]
+    for label, micros in results:
+        print(f'{label:<30} {micros:8.3f} us')
@@ -0,0 +1,55 @@
+from pyrogram import Client
+from pyrogram.types import Message
+
+from __init__ import queueDB
+
+# bot.py runs as __main__ while plugins import it as `bot`, so both sides
+# must share these through this module rather than bot.py's globals
+
+# user_id -> (merge_mode, rendered message ids, keyboard rows)
+queueMarkup = {}
+# user_id -> {message id: {"name", "size"}} of the queued files
+queueMeta = {}
+
+
+def forgetQueueMarkup(user_id):
+    """Drop the cached keyboard and file details of `user_id`, and of every queue that was emptied"""
+    try:
+        user_id = int(user_id)
+        queueMarkup.pop(user_id, None)
+        queueMeta.pop(user_id, None)
+    except (TypeError, ValueError):
+        pass
+    for cache in (queueMarkup, queueMeta):
+        for uid in [u for u in cache if not (queueDB.get(u) or {}).get("videos")]:
+            del cache[uid]
+
+
+def rememberQueuedFile(user_id: int, m: Message):
+    """Keep name and size of a queued file so the queue keyboard needs no lookups"""
+    media = m.video or m.document or m.audio
+    queueMeta.setdefault(user_id, {})[str(m.id)] = {
+        "name": media.file_name,
+        "size": media.file_size,
+    }
+
+
+async def queuedFileMeta(bot: Client, user_id: int, ids: list) -> dict:
+    """
+    Name and size of the queued files `ids` of `user_id`.
+
+    Files queued before a restart have no saved details, they are fetched
+    once and kept.
+
+    returns: message id (as str) -> {"name", "size"}
+    """
+    meta = queueMeta.setdefault(user_id, {})
+    missing = [i for i in ids if str(i) not in meta]
+    if missing:
+        for i in await bot.get_messages(chat_id=user_id, message_ids=missing):
+            media = i.video or i.document or i.audio or None
+            meta[str(i.id)] = {
+                "name": media.file_name if media else None,
+                "size": media.file_size if media else None,
+            }
+    return meta
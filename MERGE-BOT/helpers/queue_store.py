@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from __init__ import LOGGER, formatDB, queueDB, replyDB
+from config import Config
+
+
+class QueueStore(object):
+    """
+    SQLite copy of queueDB, formatDB and replyDB that survives restarts.
+
+    The dicts imported from __init__ stay the hot layer every handler reads
+    and mutates. `save(user_id)` persists one user right away and
+    `drop(user_id)` forgets a cleared queue right away. A background thread
+    reconciles the whole store every QUEUE_SYNC_INTERVAL seconds so queues
+    cleared elsewhere are dropped too; it takes its snapshot of the dicts
+    on the event loop, which owns them, and only writes off the loop.
+    Finished downloads are recorded so an interrupted merge can resume
+    instead of fetching every part again. Nothing touches the disk before
+    `init()`.
+    """
+
+    def __init__(self, path: str, sync_interval: int):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._sync_interval = sync_interval
+        self._thread = None
+        self._loop = None
+        # user_id -> time its queue was dropped, so a sync can't bring it back
+        self._dropped = {}
+
+    def init(self):
+        """Open the database, creating its folder and tables if needed"""
+        if self._conn is not None:
+            return
+        if os.path.dirname(self._path):
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queues ("
+            "user_id INTEGER PRIMARY KEY, queue TEXT, format TEXT, reply INTEGER, updated REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            "user_id INTEGER, message_id INTEGER, path TEXT, size INTEGER, "
+            "PRIMARY KEY (user_id, message_id))"
+        )
+
+    def save(self, user_id: int):
+        queue = queueDB.get(user_id)
+        if queue is None:
+            return self.drop(user_id)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queues VALUES (?, ?, ?, ?, ?)",
+                (
+                    user_id,
+                    json.dumps(queue, separators=(",", ":")),
+                    formatDB.get(user_id),
+                    replyDB.get(user_id),
+                    time.time(),
+                ),
+            )
+
+    def drop(self, user_id: int):
+        with self._lock:
+            self._dropped[user_id] = time.time()
+            self._conn.execute("DELETE FROM queues WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM downloads WHERE user_id = ?", (user_id,))
+
+    def restore(self) -> int:
+        """Load every saved queue into the in-memory dicts"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, queue, format, reply FROM queues"
+            ).fetchall()
+        for user_id, queue, format_, reply in rows:
+            queueDB[user_id] = json.loads(queue)
+            if format_ is not None:
+                formatDB[user_id] = format_
+            if reply is not None:
+                replyDB[user_id] = reply
+        LOGGER.info(f"Restored {len(rows)} pending queues")
+        return len(rows)
+
+    def snapshot(self):
+        """
+        Serialize every in-memory queue, on the event loop only, where the
+        dicts can't change underneath.
+
+        returns: (time taken, rows for the queues table)
+        """
+        taken = time.time()
+        rows = [
+            (
+                user_id,
+                json.dumps(queue, separators=(",", ":")),
+                formatDB.get(user_id),
+                replyDB.get(user_id),
+                taken,
+            )
+            for user_id, queue in queueDB.items()
+            if queue is not None
+        ]
+        return taken, rows
+
+    def sync(self, taken: float, rows: list):
+        """Write a `snapshot()` and forget the queues that are gone"""
+        users = [row[0] for row in rows]
+        with self._lock:
+            # saves and drops made after the snapshot are newer than it
+            rows = [row for row in rows if self._dropped.get(row[0], 0) < taken]
+            self._conn.executemany(
+                "INSERT INTO queues VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+                "queue = excluded.queue, format = excluded.format, "
+                "reply = excluded.reply, updated = excluded.updated "
+                "WHERE excluded.updated >= queues.updated",
+                rows,
+            )
+            gone = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT user_id FROM queues WHERE updated < ?", (taken,)
+                ).fetchall()
+                if row[0] not in users
+            ]
+            for user_id in gone:
+                self._conn.execute("DELETE FROM queues WHERE user_id = ?", (user_id,))
+                self._conn.execute("DELETE FROM downloads WHERE user_id = ?", (user_id,))
+            for user_id in [u for u, t in self._dropped.items() if t < taken]:
+                del self._dropped[user_id]
+
+    def reclaimLocks(self, root: str = "downloads") -> int:
+        """
+        Remove `input.txt` merge locks left behind by a previous run. No
+        merge survives a restart, so every lock found at boot is stale.
+        """
+        reclaimed = 0
+        if not os.path.isdir(root):
+            return reclaimed
+        for entry in os.listdir(root):
+            lock = os.path.join(root, entry, "input.txt")
+            if os.path.isfile(lock):
+                os.remove(lock)
+                reclaimed += 1
+        LOGGER.info(f"Reclaimed {reclaimed} stale merge locks")
+        return reclaimed
+
+    def markDownloaded(self, user_id: int, message_id: int, path: str, size: int):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)",
+                (user_id, message_id, path, size),
+            )
+
+    def downloaded(self, user_id: int, message_id: int, size: int):
+        """returns: path of a finished download of `message_id`, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM downloads WHERE user_id = ? AND message_id = ? AND size = ?",
+                (user_id, message_id, size),
+            ).fetchone()
+        if row is None:
+            return None
+        if os.path.isfile(row[0]) and os.path.getsize(row[0]) == size:
+            return row[0]
+        return None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Start syncing the queues owned by `loop`"""
+        self._loop = loop
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._sync_loop, name="queue-sync", daemon=True
+        )
+        self._thread.start()
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self._sync_interval)
+            try:
+                self.sync(*self._onLoop(self.snapshot))
+            except Exception as e:
+                LOGGER.error(f"Queue sync failed: {e}")
+
+
+    def _onLoop(self, func):
+        """Call `func` on the event loop and wait for its result"""
+
+        async def call():
+            return func()
+
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+
+queueStore = QueueStore(Config.QUEUE_DB_PATH, Config.QUEUE_SYNC_INTERVAL)
@@ -0,0 +1,203 @@
+import configparser
+import json
+import os
+import re
+import threading
+
+from __init__ import LOGGER
+from config import Config
+
+# rclone flag for every tunable upload setting
+TUNING_FLAGS = {
+    "chunk_size": "--drive-chunk-size",
+    "transfers": "--transfers",
+    "buffer_size": "--buffer-size",
+}
+# remote types that understand --drive-chunk-size
+DRIVE_TYPES = ("drive",)
+# rclone size values: a number with an optional b/k/M/G/T/P suffix
+SIZE_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)([bkmgtp]?)(?:i?b)?$", re.IGNORECASE)
+SIZE_UNITS = {"": 1024, "b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4, "p": 1024**5}
+MAX_TRANSFERS = 64
+
+
+def parseSize(value: str):
+    """returns: bytes of an rclone size value like `64M`, or None if invalid"""
+    match = SIZE_PATTERN.match(value.strip())
+    if match is None:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def checkTuning(key: str, value: str):
+    """Raise ValueError unless rclone would accept `value` for `key`"""
+    if key == "transfers":
+        if not value.isdigit() or not 1 <= int(value) <= MAX_TRANSFERS:
+            raise ValueError(f"`transfers` must be a number from 1 to {MAX_TRANSFERS}")
+        return
+    size = parseSize(value)
+    if size is None:
+        raise ValueError(f"`{key}` must be a size like 32M or 1G")
+    # the drive backend refuses anything else
+    if key == "chunk_size" and (size < 256 * 1024 or size & (size - 1)):
+        raise ValueError("`chunk_size` must be a power of two of at least 256k")
+
+
+def confPath(uid: int) -> str:
+    return f"./userdata/{uid}/rclone.conf"
+
+
+def _cachePath(uid: int) -> str:
+    return f"./userdata/{uid}/remotes.json"
+
+
+class RcloneRegistry(object):
+    """
+    Parsed view of every user's rclone.conf.
+
+    The remotes of a config are parsed once per file mtime and kept in
+    memory, and written next to the config as `remotes.json` together with
+    the user's chosen remote, streaming mode and upload tuning, so a
+    restart neither re-parses unchanged configs nor forgets the choices.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # uid -> {"mtime", "remotes": {name: type}, "remote", "tuning", "stream"}
+        self._entries = {}
+
+    def get(self, uid: int):
+        """
+        returns: the user's entry, or None if they have no rclone.conf
+        """
+        path = confPath(uid)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None:
+                entry = self._loadCache(uid)
+            if entry is None or entry["mtime"] != mtime:
+                entry = self._parse(uid, path, mtime, entry)
+                self._saveCache(uid, entry)
+            self._entries[uid] = entry
+            return entry
+
+    def remotes(self, uid: int) -> dict:
+        entry = self.get(uid)
+        return dict(entry["remotes"]) if entry else {}
+
+    def remote(self, uid: int):
+        """returns: the chosen remote name, or None"""
+        entry = self.get(uid)
+        return entry["remote"] if entry else None
+
+    def select(self, uid: int, remote: str = None, stream: bool = None, **tuning):
+        """
+        Choose the upload remote, streaming mode and/or tuning values for `uid`.
+
+        Parameters:
+        - `remote`: Name of a remote in the user's config.
+        - `stream`: Pipe ffmpeg's output straight to the remote instead of
+          staging files under downloads/.
+        - `tuning`: Any of chunk_size, transfers, buffer_size. None resets
+          a value to its default.
+
+        returns: the updated entry
+        """
+        entry = self.get(uid)
+        if entry is None:
+            raise ValueError("No rclone config saved")
+        if remote is not None and remote not in entry["remotes"]:
+            raise ValueError(f"Unknown remote `{remote}`")
+        unknown = set(tuning) - set(TUNING_FLAGS)
+        if unknown:
+            raise ValueError(f"Unknown setting `{unknown.pop()}`")
+        for key, value in tuning.items():
+            if value is not None:
+                checkTuning(key, str(value))
+        with self._lock:
+            if remote is not None:
+                entry["remote"] = remote
+            if stream is not None:
+                entry["stream"] = bool(stream)
+            for key, value in tuning.items():
+                if value is None:
+                    entry["tuning"].pop(key, None)
+                else:
+                    entry["tuning"][key] = str(value)
+            self._saveCache(uid, entry)
+        return entry
+
+    def tuning(self, uid: int) -> dict:
+        """returns: effective tuning values, user choices over the defaults"""
+        values = {
+            "chunk_size": Config.RCLONE_DRIVE_CHUNK_SIZE,
+            "transfers": str(Config.RCLONE_TRANSFERS),
+            "buffer_size": Config.RCLONE_BUFFER_SIZE,
+        }
+        entry = self.get(uid)
+        if entry is not None:
+            values.update(entry["tuning"])
+        return values
+
+    def streaming(self, uid: int) -> bool:
+        """returns: True if `uid` wants Drive output streamed without staging"""
+        entry = self.get(uid)
+        return bool(entry and entry.get("stream"))
+
+    def flags(self, uid: int) -> list:
+        """returns: rclone copy flags for the user's chosen remote"""
+        remote_type = self.remotes(uid).get(self.remote(uid))
+        flags = []
+        for key, value in self.tuning(uid).items():
+            if key == "chunk_size" and remote_type not in DRIVE_TYPES:
+                continue
+            flags.append(f"{TUNING_FLAGS[key]}={value}")
+        return flags
+
+    def invalidate(self, uid: int):
+        """Forget the parsed config of `uid`, e.g. after a new one is saved"""
+        with self._lock:
+            self._entries.pop(uid, None)
+
+    def _parse(self, uid: int, path: str, mtime: float, previous: dict = None) -> dict:
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(path, encoding="utf-8")
+        remotes = {
+            name: parser.get(name, "type", fallback="unknown")
+            for name in parser.sections()
+        }
+        previous = previous or {}
+        remote = previous.get("remote")
+        if remote not in remotes:
+            remote = next(iter(remotes), None)
+        LOGGER.info(f"Parsed {len(remotes)} rclone remotes for {uid}")
+        return {
+            "mtime": mtime,
+            "remotes": remotes,
+            "remote": remote,
+            "tuning": dict(previous.get("tuning", {})),
+            "stream": previous.get("stream", False),
+        }
+
+    def _loadCache(self, uid: int):
+        try:
+            with open(_cachePath(uid), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _saveCache(self, uid: int, entry: dict):
+        path = _cachePath(uid)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            LOGGER.warning(f"Could not write {path}: {e}")
+
+
+rcloneRegistry = RcloneRegistry()
@@ -1,18 +1,37 @@
 import os
 import re
-import subprocess
 import time
 import asyncio
 import json
 import traceback
+from collections import OrderedDict
 from pyrogram.client import Client
-from pyrogram.errors import FloodWait, MessageNotModified
 from pyrogram.types import CallbackQuery, Message
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from helpers import database
+from helpers.rclone_config import confPath, rcloneRegistry
+from helpers.display_progress import TimeFormatter, humanbytes, progressDispatcher
+from helpers.ffmpeg_helper import (
+    readLines,
+    runCommandToPipe,
+    streamingExtractCommands,
+    streamingMergeCommand,
+)
+from helpers.scheduler import scheduled, scheduler
 from __init__ import LOGGER
 
 
+REMOTE_META_CACHE_SIZE = 512
+# (conf path, remote path) -> (conf mtime, (id, name)), entries made
+# under an older config are ignored. Drive updates an object in place,
+# so an upload keeps its ID and only deleting the path drops the entry.
+_remoteMeta: OrderedDict = OrderedDict()
+
+CANCEL_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("Cancel", callback_data="cancel")]]
+)
+
+
 class Status:
     # Shared List
     Tasks = []
@@ -58,19 +77,22 @@ class RCUploadTask(Status):
     async def set_message(self, message):
         self._message = message
 
-    async def refresh_info(self, msg):
+    async def refresh_info(self, stats: dict):
         # The rclone is process dependent so cant be updated here.
-        self._upmsg = msg
+        self._upmsg = stats
 
     async def create_message(self):
-        mat = re.findall("Transferred:.*ETA.*", self._upmsg)
-        nstr = mat[0].replace("Transferred:", "")
-        nstr = nstr.strip()
-        nstr = nstr.split(",")
-        prg = nstr[1].strip("% ")
+        stats = self._upmsg
+        done = stats.get("bytes") or 0
+        total = stats.get("totalBytes") or 0
+        prg = int(done * 100 / total) if total else 0
         prg = "Progress:- {} - {}%".format(self.progress_bar(prg), prg)
-        progress = "<b>Uploaded:- {} \n{} \nSpeed:- {} \nETA:- {}</b> \n<b>Using Engine:- </b><code>RCLONE</code>".format(
-            nstr[0], prg, nstr[2], nstr[3].replace("ETA", "")
+        progress = "<b>Uploaded:- {} / {} \n{} \nSpeed:- {}/s \nETA:- {}</b> \n<b>Using Engine:- </b><code>RCLONE</code>".format(
+            humanbytes(done) or "0 B",
+            humanbytes(total) or "?",
+            prg,
+            humanbytes(stats.get("speed") or 0) or "0 B",
+            TimeFormatter((stats.get("eta") or 0) * 1000) or "-",
         )
         return progress
 
@@ -98,19 +120,12 @@ class RCUploadTask(Status):
         if not self._prev_cont == progress:
             # kept just in case
             self._prev_cont = progress
-            try:
-                await self._message.edit(
-                    progress,
-                    reply_markup=InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("Cancel", callback_data="cancel")]]
-                    ),
-                )
-            except MessageNotModified as e:
-                LOGGER.info("{}".format(e))
-            except FloodWait as e:
-                LOGGER.info("{}".format(e))
-            except Exception as e:
-                LOGGER.info("Not expected {}".format(e))
+            total = self._upmsg.get("totalBytes") or 0
+            await progressDispatcher.submit(
+                self._message,
+                lambda: (progress, CANCEL_MARKUP),
+                final=total > 0 and (self._upmsg.get("bytes") or 0) >= total,
+            )
 
     async def is_active(self):
         return self._active
@@ -121,16 +136,19 @@ class RCUploadTask(Status):
             self._error = error
 
 
+@scheduled("upload")
 async def rclone_driver(userMess: Message, cb: CallbackQuery, merged_video_path):
-    conf_path = f"./userdata/{cb.from_user.id}/rclone.conf"
+    conf_path = confPath(cb.from_user.id)
     dl_task = None
     ul_task = RCUploadTask(dl_task)
-    DRIVE_NAME = (
-        open(conf_path, "r").readlines()[0].removesuffix("]\n").removeprefix("[")
-    )
     BASE_DIR = "/"
     edtime = 5
     try:
+        # a malformed config raises here, report it like any other failure
+        DRIVE_NAME = rcloneRegistry.remote(cb.from_user.id)
+        if DRIVE_NAME is None:
+            await cb.message.reply_text("**No rclone remote found in your config.**")
+            return
         return await rclone_upload(
             merged_video_path,
             userMess,
@@ -141,10 +159,12 @@ async def rclone_driver(userMess: Message, cb: CallbackQuery, merged_video_path)
             edtime,
             conf_path,
             ul_task,
+            rcloneRegistry.flags(cb.from_user.id),
         )
     except Exception as er:
         await ul_task.set_inactive()
         LOGGER.info("Stuff gone wrong in here: " + str(er))
+        await cb.message.reply_text(f"**Rclone upload failed**\n\n<code>{er}</code>")
         return
 
 
@@ -158,6 +178,7 @@ async def rclone_upload(
     edTime,
     conf_path: str,
     task: RCUploadTask,
+    flags: list = None,
 ):
     a = 1
     await task.set_original_message(userMess)
@@ -177,19 +198,33 @@ async def rclone_upload(
         f"{DRIVE_NAME}:{BASE_DIR}",
         "-f",
         "- *.!qB",
-        "--buffer-size=1M",
-        "-P",
+        *(flags or ["--buffer-size=1M"]),
+        "--use-json-log",
+        f"--stats={edTime}s",
+        "--stats-log-level=NOTICE",
     ]
-    rclonePr = subprocess.Popen(rclone_copy_cmd, stdout=subprocess.PIPE)
-    rcloneResult = await rclone_process_display(
-        rclonePr, edTime, msg, mess, userMess, task
+    rclonePr = await asyncio.create_subprocess_exec(
+        *rclone_copy_cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
     )
-    if rcloneResult is False:
+    try:
+        returncode, error = await rclone_process_display(rclonePr, task)
+    except asyncio.CancelledError:
+        await _stopProcess(rclonePr)
+        raise
+    if returncode is None:
         await mess.edit(f"{mess.text} \n Canceled Rclone Upload")
         await msg.delete()
-        rclonePr.kill()
         task.cancel = True
         return task
+    if returncode != 0:
+        LOGGER.error(f"rclone exited with {returncode}: {error}")
+        await task.set_inactive(error)
+        await msg.edit(
+            f"**Rclone upload failed** (exit code {returncode})\n\n<code>{error}</code>"
+        )
+        return task
 
     LOGGER.info("Upload Complete")
     gid = await getGdriveLink(
@@ -199,11 +234,14 @@ async def rclone_upload(
         conf_path=conf_path,
         isdir=False,
     )
-    file_link = f"https://drive.google.com/file/d/{gid[0]}/view"
-    button = [InlineKeyboardButton("Drive url", url=file_link)]
+    reply_markup = None
+    if gid is not None:
+        file_link = f"https://drive.google.com/file/d/{gid[0]}/view"
+        button = [InlineKeyboardButton("Drive url", url=file_link)]
+        reply_markup = InlineKeyboardMarkup([button])
     await cb.message.reply_text(
         text=f"**UPLOADED FILE :-**\n<code>{os.path.basename(merged_video_path)}</code>\nTo Drive.",
-        reply_markup=InlineKeyboardMarkup([button]),
+        reply_markup=reply_markup,
     )
 
     LOGGER.info(f"Uploaded folder id: {gid}")
@@ -211,43 +249,253 @@ async def rclone_upload(
     return task
 
 
-async def rclone_process_display(
-    process: subprocess.Popen,
-    edit_time,
-    msg: Message,
-    mess: Message,
-    userMess: Message,
-    task: RCUploadTask,
-):
-    blank = 0  #
-    sleeps = False  #
-    start = time.time()  # Get current time
-    while True:
-        data: str = process.stdout.readline().decode()
-        data = data.strip()
-        mat = re.findall("Transferred:.*ETA.*", data)
-        if mat is not None:
-            if len(mat) > 0:
-                sleeps = True
-                if time.time() - start > edit_time:
-                    start = time.time()
-                    await task.refresh_info(data)
-                    await task.update_message()
-
-        if data == "":
-            blank += 1
-            if blank == 20:
-                break
-        else:
-            blank = 0
-
-        if sleeps:
-            sleeps = False
-            await asyncio.sleep(2)
-            process.stdout.flush()
+async def rclone_stream_merge(userMess: Message, cb: CallbackQuery, input_file: str, format_: str, file_name: str):
+    """
+    Merge the videos listed in `input_file` straight into the user's
+    remote, for users with streaming uploads on (`rcloneRegistry.streaming`).
+
+    Parameters:
+    - `file_name`: Name of the merged file on the remote, without extension.
+
+    returns: RCUploadTask, or None if no remote is configured
+    """
+    cmd, ext = streamingMergeCommand(input_file, format_)
+    return await rclone_stream_driver(userMess, cb, cmd, f"{file_name}.{ext}")
+
+
+async def rclone_stream_extract(userMess: Message, cb: CallbackQuery, path_to_file: str, codec_types: tuple):
+    """
+    Extract every stream of `codec_types` out of `path_to_file` straight
+    into the user's remote, one object per stream, for users with
+    streaming uploads on.
+
+    returns: RCUploadTask of every stream, empty when there was none
+    """
+    tasks = []
+    for cmd, file_name in await streamingExtractCommands(path_to_file, codec_types):
+        task = await rclone_stream_driver(userMess, cb, cmd, file_name)
+        if task is None or task.cancel:
+            break
+        tasks.append(task)
+    return tasks
+
+
+async def rclone_stream_driver(userMess: Message, cb: CallbackQuery, cmd: list, file_name: str):
+    """
+    Upload the stdout of ffmpeg `cmd` straight to the user's remote with
+    `rclone rcat`, so nothing is staged under downloads/ and the upload
+    runs while ffmpeg is still muxing. The job holds a process and an
+    upload slot, taken in that order like every merge then upload.
+
+    Parameters:
+    - `cmd`: ffmpeg command writing to `pipe:1`, e.g. from `streamingMergeCommand`.
+    - `file_name`: Name of the object created on the remote.
+
+    returns: RCUploadTask, or None if no remote is configured
+    """
+    user_id = cb.from_user.id
+    conf_path = confPath(user_id)
+    try:
+        DRIVE_NAME = rcloneRegistry.remote(user_id)
+    except Exception as er:
+        LOGGER.info(f"Can't read rclone config of {user_id}: {er}")
+        await cb.message.reply_text(f"**Rclone upload failed**\n\n<code>{er}</code>")
+        return
+    if DRIVE_NAME is None:
+        await cb.message.reply_text("**No rclone remote found in your config.**")
+        return
+    BASE_DIR = "/"
+    edTime = 5
+    remote_path = f"{DRIVE_NAME}:{os.path.join(BASE_DIR, file_name)}"
+    task = RCUploadTask(None)
+    await task.set_original_message(userMess)
+    msg: Message = await cb.message.reply_text(
+        "**Streaming to configured drive.... will be updated soon.**",
+        reply_markup=CANCEL_MARKUP,
+    )
+    await task.set_message(msg)
+    async with scheduler.slot("process", user_id, msg), scheduler.slot(
+        "upload", user_id, msg
+    ):
+        read_fd, write_fd = os.pipe()
+        try:
+            rclonePr = await asyncio.create_subprocess_exec(
+                "rclone",
+                "rcat",
+                f"--config={conf_path}",
+                *rcloneRegistry.flags(user_id),
+                "--use-json-log",
+                f"--stats={edTime}s",
+                "--stats-log-level=NOTICE",
+                remote_path,
+                stdin=read_fd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except BaseException:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        pipe = {"fd": write_fd}
+
+        async def mux():
+            # runCommandToPipe owns the fd from here on
+            return await runCommandToPipe(cmd, pipe.pop("fd"))
+
+        muxer = asyncio.ensure_future(mux())
+        try:
+            try:
+                returncode, error = await rclone_process_display(rclonePr, task)
+            except BaseException:
+                muxer.cancel()
+                await _stopProcess(rclonePr)
+                raise
+            if returncode is None:
+                muxer.cancel()
+            else:
+                # rclone failing makes ffmpeg exit on the broken pipe
+                ffmpeg_code, ffmpeg_log = await muxer
+        finally:
+            # a muxer cancelled before it ran never took the fd
+            if pipe:
+                os.close(pipe.pop("fd"))
+    if returncode is not None and ffmpeg_code != 0:
+        LOGGER.error(f"ffmpeg exited with {ffmpeg_code}:\n{ffmpeg_log}")
+        if returncode == 0:
+            returncode, error = ffmpeg_code, f"ffmpeg exited with {ffmpeg_code}"
+    if returncode != 0:
+        # never leave a truncated object behind
+        await _deleteRemote(conf_path, remote_path)
+    if returncode is None:
+        await cb.message.edit(f"{cb.message.text} \n Canceled Rclone Upload")
+        await msg.delete()
+        task.cancel = True
+        return task
+    if returncode != 0:
+        LOGGER.error(f"Streaming upload of {remote_path} failed: {error}")
+        await task.set_inactive(error)
+        await msg.edit(f"**Streaming upload failed**\n\n<code>{error}</code>")
+        return task
+
+    LOGGER.info("Upload Complete")
+    gid = await getGdriveLink(
+        driveName=DRIVE_NAME,
+        baseDir=BASE_DIR,
+        entName=file_name,
+        conf_path=conf_path,
+        isdir=False,
+    )
+    reply_markup = None
+    if gid is not None:
+        file_link = f"https://drive.google.com/file/d/{gid[0]}/view"
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Drive url", url=file_link)]])
+    await cb.message.reply_text(
+        text=f"**UPLOADED FILE :-**\n<code>{file_name}</code>\nTo Drive.",
+        reply_markup=reply_markup,
+    )
+    await msg.delete()
+    return task
+
+
+async def _deleteRemote(conf_path: str, remote_path: str):
+    _remoteMeta.pop((os.path.abspath(conf_path), remote_path), None)
+    process = await asyncio.create_subprocess_exec(
+        "rclone",
+        "deletefile",
+        f"--config={conf_path}",
+        remote_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    await process.wait()
+
+
+async def rclone_process_display(process: asyncio.subprocess.Process, task: RCUploadTask):
+    """
+    Follow rclone's JSON log on stderr and show its stats in the task's
+    message until the process exits or the task is cancelled.
+
+    returns: (returncode, last error message), returncode is None when
+    the upload was cancelled
+    """
+    error = ""
+    # rclone's JSON stats lines can outgrow the StreamReader line limit
+    async for line in readLines(process.stderr):
+        if task.cancel:
+            await _stopProcess(process)
+            return None, error
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if "stats" in entry:
+            await task.refresh_info(entry["stats"])
+            await task.update_message()
+        elif entry.get("level") in ("error", "critical"):
+            error = entry.get("msg", "")
+            LOGGER.info(f"rclone: {error}")
+    await process.wait()
+    if task.cancel:
+        return None, error
+    return process.returncode, error
+
+
+async def _stopProcess(process: asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
 
 
 async def getGdriveLink(driveName, baseDir, entName: str, conf_path: str, isdir=True):
+    """
+    Look up the Drive ID of `baseDir/entName` with a single `lsjson --stat`
+    of that exact path instead of listing the whole folder.
+
+    returns: (id, name) or None
+    """
+    remote_path = f"{driveName}:{os.path.join(baseDir, entName)}"
+    key = (os.path.abspath(conf_path), remote_path)
+    mtime = os.path.getmtime(conf_path)
+    cached = _remoteMeta.get(key)
+    if cached is not None and cached[0] == mtime:
+        _remoteMeta.move_to_end(key)
+        return cached[1]
+    process = await asyncio.create_subprocess_exec(
+        "rclone",
+        "lsjson",
+        f"--config={conf_path}",
+        "--stat",
+        "--no-mimetype",
+        "--no-modtime",
+        remote_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    try:
+        data = json.loads(stdout.decode())
+        if data.get("IsDir", False) != isdir:
+            raise ValueError(f"{remote_path} is not a {'folder' if isdir else 'file'}")
+        result = (data["ID"], data["Name"])
+    except Exception:
+        LOGGER.info(
+            f"lsjson --stat failed for {remote_path}: {stderr.decode().strip()}, listing the folder"
+        )
+        # rclone older than 1.56 has no --stat
+        return await _listGdriveLink(driveName, baseDir, entName, conf_path)
+    _remoteMeta[key] = (mtime, result)
+    while len(_remoteMeta) > REMOTE_META_CACHE_SIZE:
+        _remoteMeta.popitem(last=False)
+    return result
+
+
+async def _listGdriveLink(driveName, baseDir, entName: str, conf_path: str):
     LOGGER.info("Ent - ", entName)
     entName = re.escape(entName)
     filter_path = os.path.join(os.getcwd(), str(time.time()).replace(".", "") + ".txt")
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pyrogram import Client
+from pyrogram.types import Message
+
+from __init__ import LOGGER
+from config import Config
+
+
+def resultKey(messages: list, mode: int, settings: dict = None) -> str:
+    """
+    Cache key of a job: the ordered `file_unique_id`s of its inputs plus
+    the merge mode and every setting that changes the output (upload as
+    document, thumbnail, file name, ...).
+    """
+    unique_ids = [
+        (m.video or m.document or m.audio).file_unique_id for m in messages
+    ]
+    payload = json.dumps(
+        [unique_ids, mode, settings or {}], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache(object):
+    """
+    SQLite map from a job's `resultKey` to the messages holding its
+    uploads, one per output file.
+
+    A repeated job is answered by copying those messages instead of
+    downloading, processing and uploading again. Only messages the bot
+    can copy and whose file ids it can send are stored. The least
+    recently used jobs are dropped beyond `max_entries`.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT, part INTEGER, parts INTEGER, chat_id INTEGER, "
+            "message_id INTEGER, file_id TEXT, file_name TEXT, size INTEGER, "
+            "used REAL, PRIMARY KEY (key, part))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outputs_used ON outputs (used)")
+        self._max_entries = max_entries
+
+    def get(self, key: str):
+        """
+        returns: [(chat_id, message_id, file_id, file_name), ...] of every
+        output of `key` in order, or None unless all of them are cached
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT parts, chat_id, message_id, file_id, file_name FROM outputs "
+                "WHERE key = ? ORDER BY part",
+                (key,),
+            ).fetchall()
+            if not rows or len(rows) != rows[0][0]:
+                return None
+            self._conn.execute(
+                "UPDATE outputs SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        return [row[1:] for row in rows]
+
+    def put(self, key: str, message: Message, owned: Message = None, part: int = 0, parts: int = 1):
+        """
+        Parameters:
+        - `message`: Message to copy for this output, it must be readable
+          by the bot, e.g. the LOGCHANNEL copy.
+        - `owned`: The bot's own message with the same file when `message`
+          was sent by the user session, whose file ids the bot can't use.
+        - `part`, `parts`: Position of this output and number of outputs
+          of the job.
+        """
+        source = owned or message
+        media = source.video or source.document or source.audio
+        if media is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    part,
+                    parts,
+                    message.chat.id,
+                    message.id,
+                    media.file_id,
+                    media.file_name,
+                    media.file_size,
+                    time.time(),
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM outputs WHERE key IN ("
+                "SELECT key FROM outputs GROUP BY key ORDER BY MAX(used) DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+    def drop(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+
+    async def serve(self, c: Client, key: str, chat_id: int, caption: str = None) -> bool:
+        """
+        Send the cached outputs of `key` to `chat_id`. The captions are
+        always set here, the stored messages may name the user they were
+        made for. The stored messages are looked up before anything is
+        sent, the file id of a deleted one is sent instead.
+
+        returns: True if anything was sent, False on a miss. A job that
+        broke off after its first output counts as served, so it is not
+        processed and sent a second time, and the user is told.
+        """
+        rows = self.get(key)
+        if rows is None:
+            return False
+        alive = set()
+        for source_chat in {row[0] for row in rows}:
+            ids = [row[1] for row in rows if row[0] == source_chat]
+            try:
+                found = await c.get_messages(source_chat, ids)
+            except Exception as e:
+                LOGGER.info(f"Cached messages in {source_chat} unreadable: {e}")
+                continue
+            alive.update((source_chat, m.id) for m in found if m and not m.empty)
+        sent = 0
+        for source_chat, message_id, file_id, file_name in rows:
+            text = caption or f"`{file_name}`"
+            try:
+                if (source_chat, message_id) in alive:
+                    await c.copy_message(
+                        chat_id=chat_id,
+                        from_chat_id=source_chat,
+                        message_id=message_id,
+                        caption=text,
+                    )
+                else:
+                    # the message was deleted, the file may still be reachable
+                    await c.send_cached_media(chat_id=chat_id, file_id=file_id, caption=text)
+                sent += 1
+            except Exception as e:
+                LOGGER.info(f"Cached result {key} is gone: {e}")
+                self.drop(key)
+                if not sent:
+                    return False
+                await c.send_message(
+                    chat_id=chat_id,
+                    text=f"❌ Only {sent} of {len(rows)} files could be sent, the rest of this cached result is gone.\nSend the files again to process them anew.",
+                )
+                return True
+        return True
+
+
+resultCache = ResultCache(Config.RESULT_CACHE_PATH, Config.RESULT_CACHE_SIZE)
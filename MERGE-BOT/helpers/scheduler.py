@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import inspect
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from pyrogram.types import Message
+
+from __init__ import LOGGER
+from config import Config
+
+
+class JobScheduler(object):
+    """
+    Hands out slots for the download, process and upload stages.
+
+    Every stage has a fixed number of global slots and a user may hold at
+    most `per_user` of them at a time. Waiting jobs are served round-robin
+    across users, so one user with a long queue can't starve the others.
+    """
+
+    def __init__(self, slots: dict, per_user: int):
+        self._slots = dict(slots)
+        self._per_user = per_user
+        # stage -> {user_id: running jobs}
+        self._running = {stage: {} for stage in slots}
+        # stage -> {user_id: deque of (future, message)}, in service order
+        self._waiting = {stage: OrderedDict() for stage in slots}
+        # waiting future -> last position shown to its user
+        self._announced = {}
+
+    def running(self, stage: str) -> int:
+        return sum(self._running[stage].values())
+
+    def waiting(self, stage: str) -> int:
+        return sum(len(q) for q in self._waiting[stage].values())
+
+    def position(self, stage: str, user_id: int) -> int:
+        """1-based place of the user's next waiting job, 0 if none waits"""
+        for n, (uid, _) in enumerate(self._iter_waiting(stage), start=1):
+            if uid == user_id:
+                return n
+        return 0
+
+    def _iter_waiting(self, stage: str):
+        # round-robin order: first job of every user, then the second, ...
+        queues = [(uid, list(q)) for uid, q in self._waiting[stage].items()]
+        depth = 0
+        while True:
+            emitted = False
+            for uid, jobs in queues:
+                if depth < len(jobs):
+                    emitted = True
+                    yield uid, jobs[depth]
+            if not emitted:
+                return
+            depth += 1
+
+    def _can_run(self, stage: str, user_id: int) -> bool:
+        return (
+            self.running(stage) < self._slots[stage]
+            and self._running[stage].get(user_id, 0) < self._per_user
+        )
+
+    def _grant(self, stage: str, user_id: int):
+        self._running[stage][user_id] = self._running[stage].get(user_id, 0) + 1
+
+    def _release(self, stage: str, user_id: int):
+        left = self._running[stage].get(user_id, 0) - 1
+        if left > 0:
+            self._running[stage][user_id] = left
+        else:
+            self._running[stage].pop(user_id, None)
+        if user_id in self._waiting[stage]:
+            # let everyone else go before this user's next job
+            self._waiting[stage].move_to_end(user_id)
+        self._dispatch(stage)
+
+    def _dispatch(self, stage: str):
+        waiting = self._waiting[stage]
+        granted = True
+        while granted and self.running(stage) < self._slots[stage]:
+            granted = False
+            for uid in list(waiting.keys()):
+                if not self._can_run(stage, uid):
+                    continue
+                future, _ = waiting[uid].popleft()
+                if waiting[uid]:
+                    # served users go to the back of the line
+                    waiting.move_to_end(uid)
+                else:
+                    del waiting[uid]
+                self._announced.pop(future, None)
+                granted = True
+                if not future.done():
+                    self._grant(stage, uid)
+                    future.set_result(None)
+                break
+        self._announce(stage)
+
+    def _announce(self, stage: str):
+        for n, (uid, (future, message)) in enumerate(
+            self._iter_waiting(stage), start=1
+        ):
+            if message is None or future.done() or self._announced.get(future) == n:
+                continue
+            self._announced[future] = n
+            asyncio.ensure_future(_editQuietly(message, _queuedText(stage, n)))
+
+    @asynccontextmanager
+    async def slot(self, stage: str, user_id: int, message: Message = None):
+        """
+        Wait for a `stage` slot for `user_id`, showing the queue position
+        in `message` while waiting.
+        """
+        if not self._waiting[stage] and self._can_run(stage, user_id):
+            self._grant(stage, user_id)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[stage].setdefault(user_id, deque()).append(
+                (future, message)
+            )
+            LOGGER.info(
+                f"{user_id} queued for {stage} at {self.position(stage, user_id)}"
+            )
+            # the jobs ahead may be held back only by their per-user limit
+            self._dispatch(stage)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was granted right before the cancel landed
+                    self._release(stage, user_id)
+                else:
+                    self._forget(stage, user_id, future)
+                raise
+        try:
+            yield
+        finally:
+            self._release(stage, user_id)
+
+    def _forget(self, stage: str, user_id: int, future: asyncio.Future):
+        jobs = self._waiting[stage].get(user_id)
+        if jobs is None:
+            return
+        self._announced.pop(future, None)
+        for job in list(jobs):
+            if job[0] is future:
+                jobs.remove(job)
+        if not jobs:
+            del self._waiting[stage][user_id]
+        self._announce(stage)
+
+
+def _queuedText(stage: str, position: int) -> str:
+    return f"⏳ **Queued for {stage}**\n\nPosition in queue: `{position}`"
+
+
+async def _editQuietly(message: Message, text: str):
+    try:
+        await message.edit(text)
+    except Exception as e:
+        LOGGER.info(e)
+
+
+scheduler = JobScheduler(
+    slots={
+        "download": Config.DOWNLOAD_SLOTS,
+        "process": Config.PROCESS_SLOTS,
+        "upload": Config.UPLOAD_SLOTS,
+    },
+    per_user=Config.JOBS_PER_USER,
+)
+
+
+def scheduled(stage: str):
+    """
+    Run the decorated coroutine inside a `stage` slot.
+
+    The user is taken from a `user_id` argument (with an optional editable
+    `message`), or else from a `cb` CallbackQuery argument.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            if "user_id" in arguments:
+                user_id = arguments["user_id"]
+                message = arguments.get("message")
+            else:
+                user_id = arguments["cb"].from_user.id
+                message = arguments["cb"].message
+            async with scheduler.slot(stage, user_id, message):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
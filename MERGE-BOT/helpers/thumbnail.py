@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+
+from PIL import Image, ImageFilter, ImageStat
+from pyrogram import Client
+
+from __init__ import LOGGER
+from helpers.ffmpeg_helper import probeAsync, runCommand
+
+THUMB_DIR = "downloads/thumbs"
+# Telegram wants thumbnails of at most 320px on the longest side
+THUMB_SIZE = 320
+THUMB_CACHE_SIZE = 500
+# candidate frames, as fractions of the duration
+CANDIDATE_POSITIONS = (0.1, 0.25, 0.4, 0.55, 0.7)
+# mean luma outside this range is a black or white frame
+LUMA_RANGE = (16, 240)
+# bytes hashed from each end of a video to identify it
+HASH_SPAN = 1024 * 1024
+# cache key -> future of the thumbnail being made for it
+_making = {}
+
+
+def fileHash(path: str) -> str:
+    """
+    Identify a video by its size and its first and last MiB, which is
+    enough to tell outputs apart without reading gigabytes.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(HASH_SPAN))
+        if size > HASH_SPAN:
+            f.seek(max(size - HASH_SPAN, HASH_SPAN))
+            digest.update(f.read(HASH_SPAN))
+    return digest.hexdigest()
+
+
+def _cachePath(key: str) -> str:
+    return os.path.join(THUMB_DIR, f"{key}.jpg")
+
+
+async def _once(key: str, make):
+    """Run `make()` once per `key`, concurrent callers share its result"""
+    future = _making.get(key)
+    if future is None:
+        future = asyncio.ensure_future(make())
+        _making[key] = future
+        future.add_done_callback(lambda _: _making.pop(key, None))
+    # one caller giving up must not cancel it for the others
+    return await asyncio.shield(future)
+
+
+def _store(image: Image.Image, path: str):
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    image = image.convert("RGB")
+    image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    image.save(path + ".tmp", "JPEG", quality=85)
+    os.replace(path + ".tmp", path)
+    cached = sorted(
+        (
+            os.path.join(THUMB_DIR, name)
+            for name in os.listdir(THUMB_DIR)
+            if name.endswith(".jpg")
+        ),
+        key=os.path.getmtime,
+    )
+    for old in cached[: max(len(cached) - THUMB_CACHE_SIZE, 0)]:
+        os.remove(old)
+
+
+def _score(path: str):
+    """returns: detail of the frame, or None for a black/white frame"""
+    with Image.open(path) as image:
+        gray = image.convert("L")
+        gray.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    luma = ImageStat.Stat(gray).mean[0]
+    if not LUMA_RANGE[0] <= luma <= LUMA_RANGE[1]:
+        return None
+    return ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).stddev[0]
+
+
+async def videoThumbnail(video_file: str, duration: float = 0):
+    """
+    Thumbnail for `video_file` from the most detailed of a few candidate
+    frames, all grabbed by one ffmpeg run. The result is cached by
+    `fileHash`, so uploading the same output again skips the grab.
+
+    returns: path of a 320px JPEG, or None
+    """
+    key = await asyncio.to_thread(fileHash, video_file)
+    path = _cachePath(key)
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    return await _once(key, lambda: _grabThumbnail(video_file, duration, key, path))
+
+
+async def _grabThumbnail(video_file: str, duration: float, key: str, path: str):
+    if duration <= 0:
+        try:
+            duration = float((await probeAsync(video_file))["format"]["duration"])
+        except Exception as e:
+            LOGGER.info(f"Can't probe {video_file}: {e}")
+            return None
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f"{key}.", dir=THUMB_DIR)
+    cmd = ["ffmpeg", "-hide_banner", "-y"]
+    for position in CANDIDATE_POSITIONS:
+        cmd += ["-ss", f"{duration * position:.3f}", "-i", video_file]
+    candidates = []
+    for n in range(len(CANDIDATE_POSITIONS)):
+        candidate = os.path.join(workdir, f"{n}.jpg")
+        candidates.append(candidate)
+        cmd += ["-map", f"{n}:V:0", "-frames:v", "1", candidate]
+    try:
+        returncode, _, stderr = await runCommand(cmd)
+        candidates = [c for c in candidates if os.path.exists(c)]
+        if not candidates:
+            LOGGER.info(f"No thumbnail frames for {video_file}: {stderr}")
+            return None
+        scores = await asyncio.to_thread(lambda: [_score(c) for c in candidates])
+        ranked = [(s, c) for s, c in zip(scores, candidates) if s is not None]
+        # every frame dark: still better than no thumbnail
+        best = max(ranked)[1] if ranked else candidates[0]
+        with Image.open(best) as image:
+            await asyncio.to_thread(_store, image, path)
+        return path
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def userThumbnail(c: Client, thumb_id: str):
+    """
+    The user's custom thumbnail as a 320px JPEG, downloaded once per
+    `thumb_id` and reused afterwards.
+
+    returns: path of the thumbnail, or None
+    """
+    key = "user-" + hashlib.sha1(thumb_id.encode()).hexdigest()
+    path = _cachePath(key)
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    return await _once(key, lambda: _downloadThumbnail(c, thumb_id, path))
+
+
+async def _downloadThumbnail(c: Client, thumb_id: str, path: str):
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    try:
+        downloaded = await c.download_media(message=thumb_id, file_name=path + ".part")
+    except Exception as e:
+        LOGGER.info(f"Can't download thumbnail {thumb_id}: {e}")
+        return None
+    if downloaded is None:
+        LOGGER.info(f"Thumbnail {thumb_id} could not be downloaded")
+        return None
+    try:
+        with Image.open(downloaded) as image:
+            await asyncio.to_thread(_store, image, path)
+    except Exception as e:
+        LOGGER.info(f"Thumbnail {thumb_id} is not a usable image: {e}")
+        return None
+    finally:
+        os.remove(downloaded)
+    return path
+
+
+async def getThumbnail(c: Client, video_file: str, duration: float = 0, thumb_id: str = None):
+    """returns: the user's thumbnail if they set one, else a frame of `video_file`"""
+    if thumb_id is not None:
+        path = await userThumbnail(c, thumb_id)
+        if path is not None:
+            return path
+    return await videoThumbnail(video_file, duration)
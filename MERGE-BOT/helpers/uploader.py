@@ -3,14 +3,34 @@ import os
 import time
 
 from __init__ import LOGGER
-from bot import LOGCHANNEL, userBot
 from config import Config
 from pyrogram import Client
-from pyrogram.types import CallbackQuery, Message
+from pyrogram.errors import FloodWait
+from pyrogram.types import (
+    CallbackQuery,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaVideo,
+    Message,
+)
 
-from helpers.display_progress import Progress
+from helpers.display_progress import BatchProgress, Progress
+from helpers.ffmpeg_helper import splitVideo
+from helpers.result_cache import resultCache
+from helpers.scheduler import scheduled
+from helpers.thumbnail import getThumbnail
+from helpers.user_session import LOGCHANNEL, userBot, userSession
+from helpers.utils import UserSettings, get_readable_file_size
 
+# Telegram accepts at most 10 items per media group
+MEDIA_GROUP_SIZE = 10
+UPLOAD_RETRIES = 3
+# largest single upload, a little under Telegram's 2 GiB / 4 GiB caps
+BOT_UPLOAD_LIMIT = 2000 * 1024 * 1024
+PREMIUM_UPLOAD_LIMIT = 4000 * 1024 * 1024
 
+
+@scheduled("upload")
 async def uploadVideo(
     c: Client,
     cb: CallbackQuery,
@@ -21,101 +41,216 @@ async def uploadVideo(
     video_thumbnail,
     file_size,
     upload_mode: bool,
+    cache_key: str = None,
 ):
+    """
+    Upload a merged file, split into parts if it is over the size limit.
+
+    A `cache_key` from `resultKey` stores the uploaded messages in
+    `resultCache` so the same job can later be answered by a copy.
+    Without a usable `video_thumbnail` the user's custom thumbnail or the
+    best frame of the video is used.
+
+    returns: the messages the user received, one per part, empty if the
+    upload failed
+    """
     # Report your errors in telegram group (@yo_codes).
-    if Config.IS_PREMIUM:
-        sent_ = None
-        prog = Progress(cb.from_user.id, c, cb.message)
-        async with userBot:
-            if upload_mode is False:
-                c_time = time.time()
-                sent_: Message = await userBot.send_video(
-                    chat_id=int(LOGCHANNEL),
-                    video=merged_video_path,
-                    height=height,
-                    width=width,
-                    duration=duration,
-                    thumb=video_thumbnail,
-                    caption=f"`{merged_video_path.rsplit('/',1)[-1]}`\n\nMerged for: {cb.from_user.mention}",
-                    progress=prog.progress_for_pyrogram,
-                    progress_args=(
-                        f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
-                        c_time,
-                    ),
-                )
-            else:
-                c_time = time.time()
-                sent_: Message = await userBot.send_document(
-                    chat_id=int(LOGCHANNEL),
-                    document=merged_video_path,
-                    thumb=video_thumbnail,
-                    caption=f"`{merged_video_path.rsplit('/',1)[-1]}`\n\nMerged for: <a href='tg://user?id={cb.from_user.id}'>{cb.from_user.first_name}</a>",
-                    progress=prog.progress_for_pyrogram,
-                    progress_args=(
-                        f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
-                        c_time,
-                    ),
-                )
-            if sent_ is not None:
-                await c.copy_message(
+    limit = PREMIUM_UPLOAD_LIMIT if Config.IS_PREMIUM else BOT_UPLOAD_LIMIT
+    if not video_thumbnail or not os.path.exists(video_thumbnail):
+        user = await UserSettings.load(cb.from_user.id, cb.from_user.first_name)
+        video_thumbnail = await getThumbnail(
+            c, merged_video_path, duration or 0, user.thumbnail
+        )
+    if os.path.getsize(merged_video_path) > limit:
+        return await uploadSplitVideo(
+            c, cb, merged_video_path, width, height, duration, video_thumbnail, upload_mode, limit, cache_key
+        )
+    uploaded = await _uploadOne(
+        c, cb, merged_video_path, width, height, duration, video_thumbnail, upload_mode
+    )
+    if uploaded is None:
+        return []
+    delivered, stored, owned = uploaded
+    if cache_key is not None:
+        resultCache.put(cache_key, stored, owned=owned)
+    return [delivered]
+
+
+async def _uploadOne(
+    c: Client,
+    cb: CallbackQuery,
+    merged_video_path,
+    width,
+    height,
+    duration,
+    video_thumbnail,
+    upload_mode: bool,
+):
+    """
+    Upload one file within the size limit and log it to LOGCHANNEL.
+
+    returns: (the user's message, the message to cache, the bot's own
+    copy when the cached one was sent by the user session), or None if
+    the upload failed
+    """
+    try:
+        if Config.IS_PREMIUM:
+            sent_ = None
+            prog = Progress(cb.from_user.id, c, cb.message)
+            async with userSession.worker():
+                if upload_mode is False:
+                    c_time = time.time()
+                    sent_: Message = await userBot.send_video(
+                        chat_id=int(LOGCHANNEL),
+                        video=merged_video_path,
+                        height=height,
+                        width=width,
+                        duration=duration,
+                        thumb=video_thumbnail,
+                        caption=f"`{merged_video_path.rsplit('/',1)[-1]}`\n\nMerged for: {cb.from_user.mention}",
+                        progress=prog.progress_for_pyrogram,
+                        progress_args=(
+                            f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
+                            c_time,
+                        ),
+                    )
+                else:
+                    c_time = time.time()
+                    sent_: Message = await userBot.send_document(
+                        chat_id=int(LOGCHANNEL),
+                        document=merged_video_path,
+                        thumb=video_thumbnail,
+                        caption=f"`{merged_video_path.rsplit('/',1)[-1]}`\n\nMerged for: <a href='tg://user?id={cb.from_user.id}'>{cb.from_user.first_name}</a>",
+                        progress=prog.progress_for_pyrogram,
+                        progress_args=(
+                            f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
+                            c_time,
+                        ),
+                    )
+                if sent_ is None:
+                    return None
+                copied = await c.copy_message(
                     chat_id=cb.message.chat.id,
                     from_chat_id=sent_.chat.id,
                     message_id=sent_.id,
                     caption=f"`{merged_video_path.rsplit('/',1)[-1]}`",
                 )
                 # await sent_.delete()
-    else:
-        try:
-            sent_ = None
-            prog = Progress(cb.from_user.id, c, cb.message)
-            if upload_mode is False:
-                c_time = time.time()
-                sent_: Message = await c.send_video(
-                    chat_id=cb.message.chat.id,
-                    video=merged_video_path,
-                    height=height,
-                    width=width,
-                    duration=duration,
-                    thumb=video_thumbnail,
-                    caption=f"`{merged_video_path.rsplit('/',1)[-1]}`",
-                    progress=prog.progress_for_pyrogram,
-                    progress_args=(
-                        f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
-                        c_time,
-                    ),
-                )
-            else:
-                c_time = time.time()
-                sent_: Message = await c.send_document(
-                    chat_id=cb.message.chat.id,
-                    document=merged_video_path,
-                    thumb=video_thumbnail,
-                    caption=f"`{merged_video_path.rsplit('/',1)[-1]}`",
-                    progress=prog.progress_for_pyrogram,
-                    progress_args=(
-                        f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
-                        c_time,
-                    ),
-                )
-        except Exception as err:
-            LOGGER.info(err)
-            await cb.message.edit("Failed to upload")
-        if sent_ is not None:
-            if Config.LOGCHANNEL is not None:
-                media = sent_.video or sent_.document
-                await sent_.copy(
-                    chat_id=int(LOGCHANNEL),
-                    caption=f"`{media.file_name}`\n\nMerged for: <a href='tg://user?id={cb.from_user.id}'>{cb.from_user.first_name}</a>",
-                )
+            # the bot can't send the user session's file ids
+            return copied, sent_, copied
+        sent_ = None
+        prog = Progress(cb.from_user.id, c, cb.message)
+        if upload_mode is False:
+            c_time = time.time()
+            sent_: Message = await c.send_video(
+                chat_id=cb.message.chat.id,
+                video=merged_video_path,
+                height=height,
+                width=width,
+                duration=duration,
+                thumb=video_thumbnail,
+                caption=f"`{merged_video_path.rsplit('/',1)[-1]}`",
+                progress=prog.progress_for_pyrogram,
+                progress_args=(
+                    f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
+                    c_time,
+                ),
+            )
+        else:
+            c_time = time.time()
+            sent_: Message = await c.send_document(
+                chat_id=cb.message.chat.id,
+                document=merged_video_path,
+                thumb=video_thumbnail,
+                caption=f"`{merged_video_path.rsplit('/',1)[-1]}`",
+                progress=prog.progress_for_pyrogram,
+                progress_args=(
+                    f"Uploading: `{merged_video_path.rsplit('/',1)[-1]}`",
+                    c_time,
+                ),
+            )
+    except Exception as err:
+        LOGGER.info(err)
+        await cb.message.edit("Failed to upload")
+        return None
+    if sent_ is None:
+        return None
+    logged = None
+    if Config.LOGCHANNEL is not None:
+        media = sent_.video or sent_.document
+        logged = await sent_.copy(
+            chat_id=int(LOGCHANNEL),
+            caption=f"`{media.file_name}`\n\nMerged for: <a href='tg://user?id={cb.from_user.id}'>{cb.from_user.first_name}</a>",
+        )
+    # the log channel copy outlives the user deleting their chat
+    return sent_, logged or sent_, None
 
 
+async def uploadSplitVideo(
+    c: Client,
+    cb: CallbackQuery,
+    merged_video_path,
+    width,
+    height,
+    duration,
+    video_thumbnail,
+    upload_mode: bool,
+    limit: int,
+    cache_key: str = None,
+):
+    """
+    Upload a file over the Telegram limit as `<name>.partNN.<ext>` parts.
+
+    Parts are cut at keyframes with stream copy, and each one is uploaded
+    while ffmpeg cuts the next. Every part is removed once it is sent.
+    Parts are never split again, the first failed part stops the upload.
+    Runs inside the caller's upload slot. The parts are stored under
+    `cache_key` only once all of them were sent.
+
+    returns: the messages the user received, one per part sent
+    """
+    await cb.message.edit(
+        f"File is larger than {get_readable_file_size(limit)}, splitting it into parts ..."
+    )
+    uploaded = []
+    try:
+        async for part, part_duration in splitVideo(merged_video_path, limit, duration or 0):
+            if os.path.getsize(part) > limit:
+                raise RuntimeError(f"{part} is still over {get_readable_file_size(limit)}")
+            sent_ = await _uploadOne(
+                c,
+                cb,
+                part,
+                width,
+                height,
+                int(part_duration),
+                video_thumbnail,
+                upload_mode,
+            )
+            if sent_ is None:
+                raise RuntimeError(f"upload of {part} failed")
+            uploaded.append(sent_)
+            os.remove(part)
+    except Exception as err:
+        LOGGER.error(f"Split upload of {merged_video_path} failed: {err}")
+        await cb.message.edit(f"Failed to upload, {len(uploaded)} parts were sent")
+        return [delivered for delivered, _, _ in uploaded]
+    if cache_key is not None:
+        for part, (_, stored, owned) in enumerate(uploaded):
+            resultCache.put(cache_key, stored, owned=owned, part=part, parts=len(uploaded))
+    return [delivered for delivered, _, _ in uploaded]
+
+
+@scheduled("upload")
 async def uploadFiles(
     c: Client,
     cb: CallbackQuery,
     up_path,
     n,
-    all
+    all,
+    cache_key: str = None,
 ):
+    """`cache_key` stores this file as output `n` of `all` of the job in `resultCache`"""
     try:
         sent_ = None
         prog = Progress(cb.from_user.id, c, cb.message)
@@ -132,12 +267,197 @@ async def uploadFiles(
             ),
         )
         if sent_ is not None:
+            logged = None
             if Config.LOGCHANNEL is not None:
-                media = sent_.video or sent_.document
-                await sent_.copy(
+                media = sent_.video or sent_.document or sent_.audio
+                logged = await sent_.copy(
                     chat_id=int(LOGCHANNEL),
                     caption=f"`{media.file_name}`\n\nExtracted by: <a href='tg://user?id={cb.from_user.id}'>{cb.from_user.first_name}</a>",
                 )
+            if cache_key is not None:
+                resultCache.put(cache_key, logged or sent_, part=n - 1, parts=all)
     except:
         1    
     1
+
+
+def _mediaGroups(items: list):
+    """
+    Split (kind, media, caption) items into consecutive media groups. A
+    group holds at most 10 items and only one kind, Telegram won't mix
+    audio or documents with anything else.
+    """
+    group = []
+    for kind, media, caption in items:
+        if group and (len(group) == MEDIA_GROUP_SIZE or group[0][0] != kind):
+            yield group
+            group = []
+        group.append((kind, media, caption))
+    if group:
+        yield group
+
+
+INPUT_MEDIA = {
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+    "video": InputMediaVideo,
+}
+
+
+@scheduled("upload")
+async def uploadFilesBatch(c: Client, cb: CallbackQuery, paths: list, cache_key: str = None):
+    """
+    Upload extracted tracks together instead of one `uploadFiles` call each.
+
+    With a LOGCHANNEL the files are uploaded there concurrently, which is
+    also their log copy, and then sent to the user by file id as media
+    groups of up to 10. Without one the media groups are sent straight
+    from the files.
+
+    Parameters:
+    - `paths`: Files to upload, in the order they should appear.
+    - `cache_key`: From `resultKey`, stores the outputs in `resultCache`
+      once every file was delivered.
+
+    returns: number of files delivered
+    """
+    paths = [p for p in paths if os.path.getsize(p) > 0]
+    if not paths:
+        return 0
+    user = cb.from_user
+    tracker = BatchProgress(
+        Progress(user.id, c, cb.message),
+        sum(os.path.getsize(p) for p in paths),
+        len(paths),
+        "Uploading extracted files",
+        "Uploaded",
+    )
+    if Config.LOGCHANNEL is None:
+        items = [("document", p, f"`{p.rsplit('/', 1)[-1]}`") for p in paths]
+        sent, failed = await _sendGroups(c, cb.message.chat.id, items, tracker)
+        await _reportUnsent(c, cb.message.chat.id, [media.rsplit("/", 1)[-1] for _, media, _ in failed])
+        _cacheOutputs(cache_key, sent, len(paths))
+        return len(sent)
+    limit = asyncio.Semaphore(Config.UPLOAD_CONCURRENCY)
+
+    async def one(path: str):
+        name = path.rsplit("/", 1)[-1]
+        caption = f"`{name}`\n\nExtracted by: <a href='tg://user?id={user.id}'>{user.first_name}</a>"
+
+        async def progress(current, total):
+            await tracker.update(path, current)
+
+        async with limit:
+            for attempt in range(1, UPLOAD_RETRIES + 1):
+                try:
+                    sent_ = await c.send_document(
+                        chat_id=int(LOGCHANNEL),
+                        document=path,
+                        caption=caption,
+                        progress=progress,
+                    )
+                    tracker.finish()
+                    return sent_
+                except FloodWait as e:
+                    LOGGER.warning(f"FloodWait of {e.value}s while uploading {name}")
+                    await asyncio.sleep(e.value + 1)
+                except Exception as err:
+                    LOGGER.info(f"Upload of {name} failed ({attempt}): {err}")
+        return None
+
+    items = []
+    names = {}
+    unsent = []
+    results = await asyncio.gather(*(one(p) for p in paths))
+    logged = [m for m in results if m is not None]
+    unsent += [p.rsplit("/", 1)[-1] for p, m in zip(paths, results) if m is None]
+    for m in logged:
+        # Telegram may turn a sent document into an audio or video message
+        kind = next((k for k in INPUT_MEDIA if getattr(m, k, None) is not None), None)
+        if kind is None:
+            continue
+        media = getattr(m, kind)
+        items.append((kind, media.file_id, f"`{media.file_name}`"))
+        names[media.file_id] = media.file_name
+    sent, failed = await _sendGroups(c, cb.message.chat.id, items)
+    unsent += [names[media] for _, media, _ in failed]
+    await _reportUnsent(c, cb.message.chat.id, unsent)
+    if len(sent) == len(logged):
+        # the log channel copies outlive the user deleting their chat
+        _cacheOutputs(cache_key, logged, len(paths))
+    return len(sent)
+
+
+def _cacheOutputs(cache_key: str, messages: list, expected: int):
+    if cache_key is None or len(messages) != expected:
+        return
+    for part, message in enumerate(messages):
+        resultCache.put(cache_key, message, part=part, parts=expected)
+
+
+async def _sendGroup(c: Client, chat_id: int, group: list):
+    """
+    Send one media group, or a single item on its own, retrying up to
+    UPLOAD_RETRIES times.
+
+    returns: the sent messages, or None if every attempt failed
+    """
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            if len(group) == 1:
+                kind, media, caption = group[0]
+                if os.path.isfile(media):
+                    return [await c.send_document(chat_id=chat_id, document=media, caption=caption)]
+                return [await c.send_cached_media(chat_id=chat_id, file_id=media, caption=caption)]
+            return await c.send_media_group(
+                chat_id=chat_id,
+                media=[
+                    INPUT_MEDIA[kind](media=media, caption=caption)
+                    for kind, media, caption in group
+                ],
+            )
+        except FloodWait as e:
+            await asyncio.sleep(e.value + 1)
+        except Exception as err:
+            LOGGER.info(f"Sending a group of {len(group)} failed ({attempt}): {err}")
+    return None
+
+
+async def _sendGroups(c: Client, chat_id: int, items: list, tracker: BatchProgress = None):
+    """
+    Send (kind, media, caption) items to `chat_id` as media groups, where
+    `media` is a file id or a local path. The items of a group that can't
+    be sent are retried one by one, so one bad file doesn't lose the rest.
+
+    returns: (the sent messages, the items that could not be sent)
+    """
+    delivered = []
+    failed = []
+    for group in _mediaGroups(items):
+        sent = await _sendGroup(c, chat_id, group)
+        if sent is not None:
+            delivered += sent
+        elif len(group) > 1:
+            for item in group:
+                sent = await _sendGroup(c, chat_id, [item])
+                if sent is None:
+                    failed.append(item)
+                else:
+                    delivered += sent
+        else:
+            failed += group
+        if tracker is not None:
+            for kind, media, caption in group:
+                tracker.finish()
+                await tracker.update(media, os.path.getsize(media))
+    return delivered, failed
+
+
+async def _reportUnsent(c: Client, chat_id: int, names: list):
+    if not names:
+        return
+    LOGGER.error(f"Could not send {len(names)} files to {chat_id}: {names}")
+    await c.send_message(
+        chat_id=chat_id,
+        text="❌ These files could not be sent:\n" + "\n".join(f"`{name}`" for name in names),
+    )
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from pyrogram import Client
+
+from __init__ import LOGGER
+from config import Config
+
+HEALTH_CHECK_TIMEOUT = 30
+# consecutive failed checks before the client is restarted
+HEALTH_CHECK_FAILURES = 3
+RECONNECT_BACKOFF_MAX = 300
+
+
+class UserSession(object):
+    """
+    Keeps the premium user client connected for the whole bot lifetime.
+
+    The client is started once at boot and a monitor pings it with
+    `get_me()` every USER_SESSION_HEALTH_INTERVAL seconds, restarting it
+    after HEALTH_CHECK_FAILURES failed pings in a row. While uploads hold
+    the client it is neither pinged nor restarted, a saturated connection
+    answers slowly and a restart would abort them. Uploads borrow it
+    through `worker()`, which reconnects on demand and lets at most
+    USER_UPLOAD_WORKERS transfers share the connection at a time.
+    """
+
+    def __init__(self, client: Client, workers: int, health_interval: int):
+        self.client = client
+        self._workers = asyncio.Semaphore(workers)
+        self._health_interval = health_interval
+        self._lock = asyncio.Lock()
+        self._monitor = None
+        # workers holding the client right now
+        self._busy = 0
+
+    async def ensure(self) -> Client:
+        """returns: the connected client, (re)connecting it if needed"""
+        # a locked session may be in the middle of a restart
+        if self.client.is_connected and not self._lock.locked():
+            return self.client
+        async with self._lock:
+            if not self.client.is_connected:
+                await self._restart()
+        return self.client
+
+    @asynccontextmanager
+    async def worker(self):
+        """Borrow the connected client for one upload"""
+        async with self._workers:
+            self._busy += 1
+            try:
+                yield await self.ensure()
+            finally:
+                self._busy -= 1
+
+    async def start(self):
+        await self.ensure()
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        if self.client.is_connected:
+            await self.client.stop()
+
+    async def _restart(self):
+        if self.client.is_connected:
+            try:
+                await self.client.stop()
+            except Exception as e:
+                LOGGER.info(f"Stopping user session: {e}")
+        LOGGER.info("Starting USER Session")
+        await self.client.start()
+
+    async def _watch(self):
+        backoff = self._health_interval
+        failures = 0
+        while True:
+            await asyncio.sleep(backoff)
+            if self._busy and self.client.is_connected:
+                # running uploads show the session works
+                failures = 0
+                continue
+            try:
+                async with self._lock:
+                    if self.client.is_connected:
+                        await asyncio.wait_for(
+                            self.client.get_me(), timeout=HEALTH_CHECK_TIMEOUT
+                        )
+                    else:
+                        await self._restart()
+                failures = 0
+                backoff = self._health_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                LOGGER.warning(
+                    f"User session check failed ({failures}/{HEALTH_CHECK_FAILURES}): {e}"
+                )
+                if failures < HEALTH_CHECK_FAILURES:
+                    continue
+                try:
+                    async with self._lock:
+                        if self._busy:
+                            LOGGER.info("Uploads are running, not restarting user session")
+                            continue
+                        LOGGER.warning("User session unhealthy, reconnecting")
+                        await self._restart()
+                    failures = 0
+                    backoff = self._health_interval
+                except Exception as err:
+                    LOGGER.error(f"User session reconnect failed: {err}")
+                    backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+
+def userSessionFor(client: Client):
+    if client is None:
+        return None
+    return UserSession(
+        client, Config.USER_UPLOAD_WORKERS, Config.USER_SESSION_HEALTH_INTERVAL
+    )
+
+
+# the one premium client of the process. bot.py runs as __main__, so helpers
+# importing it from bot would get a second, never started copy
+LOGCHANNEL = Config.LOGCHANNEL
+try:
+    if Config.USER_SESSION_STRING is None:
+        raise KeyError
+    userBot = Client(
+        name="merge-bot-user",
+        session_string=Config.USER_SESSION_STRING,
+        no_updates=True,
+    )
+
+except KeyError:
+    userBot = None
+    LOGGER.warning("No User Session, Default Bot session will be used")
+userSession = userSessionFor(userBot)
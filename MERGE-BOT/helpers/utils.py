@@ -1,10 +1,19 @@
 # (c) dishapatel010
+import atexit
+import copy
 import pickle
 import os.path
 import os
 import threading
 import time
-from helpers.database import setUserMergeSettings, getUserMergeSettings
+from collections import OrderedDict
+from __init__ import LOGGER, MERGE_MODE
+from config import Config
+from helpers.database import (
+    bulkSetUserMergeSettings,
+    getUserMergeSettings,
+    loadUserMergeSettings,
+)
 # from magic import Magic
 SIZE_UNITS = ["B", "KB", "MB", "GB", "TB", "PB"]
 
@@ -54,8 +63,132 @@ def get_readable_time(seconds: int) -> str:
     seconds = int(seconds)
     result += f"{seconds}s"
     return result
+class SettingsCache(object):
+    """
+    Per-process cache of user merge settings documents.
+
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted once `max_size` is exceeded. Writes are marked dirty and flushed
+    to Mongo in bulk by a background thread every `flush_interval` seconds.
+    """
+
+    def __init__(self, ttl: int, max_size: int, flush_interval: int):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._entries: OrderedDict = OrderedDict()  # uid -> (expires_at, doc)
+        self._dirty: dict = {}  # uid -> doc
+        self._writing: dict = {}  # uid -> doc, being flushed right now
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, uid: int):
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None:
+                # an evicted entry may still hold an unwritten change
+                doc = self._dirty.get(uid, self._writing.get(uid))
+                return None if doc is None else copy.deepcopy(doc)
+            expires_at, doc = entry
+            if (
+                expires_at < time.monotonic()
+                and uid not in self._dirty
+                and uid not in self._writing
+            ):
+                del self._entries[uid]
+                return None
+            self._entries.move_to_end(uid)
+            return copy.deepcopy(doc)
+
+    def put(self, uid: int, doc: dict, dirty: bool = False):
+        doc = copy.deepcopy(doc)
+        with self._lock:
+            self._entries[uid] = (time.monotonic() + self._ttl, doc)
+            self._entries.move_to_end(uid)
+            if dirty:
+                self._dirty[uid] = doc
+            while len(self._entries) > self._max_size:
+                # dirty documents stay in self._dirty until flushed
+                self._entries.popitem(last=False)
+        if dirty:
+            self._ensure_flusher()
+
+    def invalidate(self, uid: int):
+        """Write any pending change for `uid` and drop it from the cache"""
+        with self._lock:
+            doc = self._dirty.pop(uid, None)
+            self._entries.pop(uid, None)
+            if doc is not None:
+                self._writing[uid] = doc
+        if doc is not None:
+            self._write([doc])
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            pending, self._dirty = self._dirty, {}
+            self._writing.update(pending)
+        self._write(list(pending.values()))
+
+    def forget(self, uids: list):
+        """Drop `uids` and their unwritten changes, for deleted users"""
+        self._drop(uids)
+        # a running write may put its docs back when it fails
+        with self._flush_lock:
+            self._drop(uids)
+
+    def _drop(self, uids: list):
+        with self._lock:
+            for uid in uids:
+                self._entries.pop(uid, None)
+                self._dirty.pop(uid, None)
+                self._writing.pop(uid, None)
+
+    def _write(self, docs: list):
+        with self._flush_lock:
+            with self._lock:
+                # users forgotten while these docs waited are not written back
+                docs = [doc for doc in docs if self._writing.get(doc["_id"]) is doc]
+            try:
+                bulkSetUserMergeSettings(docs)
+            except Exception as e:
+                LOGGER.error(f"Settings flush failed, will retry: {e}")
+                with self._lock:
+                    for doc in docs:
+                        # a newer write for the same user wins over the retry
+                        self._dirty.setdefault(doc["_id"], doc)
+            finally:
+                with self._lock:
+                    for doc in docs:
+                        if self._writing.get(doc["_id"]) is doc:
+                            del self._writing[doc["_id"]]
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._flush_loop, name="settings-flush", daemon=True
+        )
+        self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+
+settingsCache = SettingsCache(
+    ttl=Config.SETTINGS_CACHE_TTL,
+    max_size=Config.SETTINGS_CACHE_SIZE,
+    flush_interval=Config.SETTINGS_FLUSH_INTERVAL,
+)
+atexit.register(settingsCache.flush)
+
+
 class UserSettings(object):
-    def __init__(self, uid: int, name:str):
+    def __init__(self, uid: int, name:str, fetch: bool = True):
         self.user_id: int = uid
         self.name: str = name
         self.merge_mode: int = 1
@@ -63,42 +196,74 @@ class UserSettings(object):
         self.allowed: bool = False
         self.thumbnail = None
         self.banned:bool = False
-        self.get()
+        self.get(fetch)
         # def __init__(self,uid:int,name:str,merge_mode:int=1,edit_metadata=False) -> None:
 
-    def get(self):
-        try:
-            cur = getUserMergeSettings(self.user_id)
+    @classmethod
+    async def load(cls, uid: int, name: str):
+        """Same as the constructor, but a cache miss is read on the database executor"""
+        if settingsCache.get(uid) is None:
+            cur = await loadUserMergeSettings(uid)
             if cur is not None:
-                self.name = cur["name"]
-                self.merge_mode = cur["user_settings"]["merge_mode"]
-                self.edit_metadata = cur["user_settings"]["edit_metadata"]
-                self.allowed = cur["isAllowed"]
-                self.thumbnail = cur["thumbnail"]
-                self.banned = cur["isBanned"]
-                return {
-                    "uid": self.user_id,
-                    "name": self.name,
-                    "user_settings": {
-                        "merge_mode": self.merge_mode,
-                        "edit_metadata": self.edit_metadata,
-                    },
-                    "isAllowed": self.allowed,
-                    "isBanned": self.banned,
-                    "thumbnail": self.thumbnail,
-                }
-            else: return self.set()
+                settingsCache.put(uid, cur)
+        return cls(uid, name, fetch=False)
+
+    def get(self, fetch: bool = True):
+        try:
+            cur = settingsCache.get(self.user_id)
+            if cur is None:
+                cur = getUserMergeSettings(self.user_id) if fetch else None
+                if cur is None:
+                    return self.set()
+                settingsCache.put(self.user_id, cur)
+            self.name = cur["name"]
+            self.merge_mode = cur["user_settings"]["merge_mode"]
+            self.edit_metadata = cur["user_settings"]["edit_metadata"]
+            self.allowed = cur["isAllowed"]
+            self.thumbnail = cur["thumbnail"]
+            self.banned = cur["isBanned"]
+            return self._as_dict()
         except Exception:
             return self.set()
 
     def set(self):
-        setUserMergeSettings(
-            uid=self.user_id,
-            name=self.name,
-            mode=self.merge_mode,
-            edit_metadata=self.edit_metadata,
-            banned=self.banned,
-            allowed=self.allowed,
-            thumbnail=self.thumbnail,
+        """Store settings in the cache; they reach Mongo on the next flush"""
+        settingsCache.put(
+            self.user_id,
+            {
+                "_id": self.user_id,
+                "name": self.name,
+                "user_settings": {
+                    "merge_mode": self.merge_mode,
+                    "edit_metadata": self.edit_metadata,
+                },
+                "isAllowed": self.allowed,
+                "isBanned": self.banned,
+                "thumbnail": self.thumbnail,
+            },
+            dirty=True,
         )
-        return self.get()
+        MERGE_MODE[self.user_id] = self.merge_mode
+        return self._as_dict()
+
+    @staticmethod
+    def invalidate(uid: int):
+        """Persist pending changes of `uid` now and force a fresh read next time"""
+        settingsCache.invalidate(uid)
+
+    @staticmethod
+    def flush():
+        settingsCache.flush()
+
+    def _as_dict(self):
+        return {
+            "uid": self.user_id,
+            "name": self.name,
+            "user_settings": {
+                "merge_mode": self.merge_mode,
+                "edit_metadata": self.edit_metadata,
+            },
+            "isAllowed": self.allowed,
+            "isBanned": self.banned,
+            "thumbnail": self.thumbnail,
+        }